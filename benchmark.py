@@ -0,0 +1,192 @@
+#!/usr/bin/python
+
+"""Times each phase of a SmartMatch run and of the array path smartmatch.py uses (load_arrays and IndexedMatch) over
+synthetic inputs of increasing size, and compares against a baseline"""
+
+# native imports
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# local imports
+from bulkloader import load_arrays
+from indexedmatch import IndexedMatch
+from resultwriter import write_assignment
+from smartmatch import SmartMatch, define_sessions, define_students
+from testinputgenerator import generate_synthetic_input
+
+PHASES = ["define_students", "define_sessions", "prematch", "match", "stats", "results_to_file",
+		  "load_arrays", "indexed_prematch", "indexed_match", "write_assignment"]
+
+
+def parse_sizes(sizes):
+	"""
+	:param sizes: comma-separated STUDENTSxSESSIONS pairs, e.g. "1000x10,100000x500"
+	:return: list of (number of students, number of sessions)
+	"""
+	parsed = []
+	for size in sizes.split(","):
+		num_students, num_sessions = size.lower().split("x")
+		parsed.append((int(num_students), int(num_sessions)))
+	return parsed
+
+
+def time_phases(classes_csv, students_csv, output_csv, presort, seed):
+	"""
+	Runs one SmartMatch over the given files, then one IndexedMatch as smartmatch.py does, timing every phase
+	:return: dictionary of wall-clock seconds, keyed by phase
+	"""
+	timings = {}
+	start = time.perf_counter()
+	students = define_students(students_csv, True, random.Random(seed))
+	timings["define_students"] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	sessions = define_sessions(classes_csv)
+	timings["define_sessions"] = time.perf_counter() - start
+
+	smart_match = SmartMatch(students, sessions, True)
+	start = time.perf_counter()
+	smart_match.prematch(presort)
+	timings["prematch"] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	smart_match.match()
+	timings["match"] = time.perf_counter() - start
+
+	with contextlib.redirect_stdout(io.StringIO()):
+		start = time.perf_counter()
+		smart_match.stats()
+		timings["stats"] = time.perf_counter() - start
+
+		start = time.perf_counter()
+		smart_match.results_to_file(output_csv)
+		timings["results_to_file"] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	arrays, report = load_arrays(classes_csv, students_csv, True)
+	timings["load_arrays"] = time.perf_counter() - start
+
+	students = list(range(arrays.get_num_students()))
+	random.Random(seed).shuffle(students)
+	indexed_match = IndexedMatch(arrays, students)
+	start = time.perf_counter()
+	indexed_match.prematch(presort)
+	timings["indexed_prematch"] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	indexed_match.match()
+	timings["indexed_match"] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	write_assignment(output_csv, arrays.sids, arrays.session_names,
+					 [index for index, choice in indexed_match.assignment()])
+	timings["write_assignment"] = time.perf_counter() - start
+	return timings
+
+
+def run_benchmarks(sizes, seed=0, skew=1.0, capacity_ratio=1.0, presort=1, repeat=3, verbose=False):
+	"""
+	Generates synthetic inputs for every size and keeps the fastest of REPEAT timings of each phase
+	:return: machine-readable benchmark report
+	"""
+	results = []
+	work_dir = tempfile.mkdtemp(prefix="match-benchmark-")
+	try:
+		for num_students, num_sessions in sizes:
+			classes_csv = os.path.join(work_dir, "classes.csv")
+			students_csv = os.path.join(work_dir, "students.csv")
+			generate_synthetic_input(classes_csv, students_csv, num_students, num_sessions, seed, skew,
+									 capacity_ratio)
+			best = {}
+			for run in range(repeat):
+				output_csv = os.path.join(work_dir, "output" + str(run) + ".csv")
+				timings = time_phases(classes_csv, students_csv, output_csv, presort, seed + run)
+				os.remove(output_csv)
+				for phase in timings:
+					best[phase] = min(best.get(phase, float('Inf')), timings[phase])
+			results.append({"students": num_students, "sessions": num_sessions, "seconds": best})
+			if verbose:
+				print(str(num_students) + " students x " + str(num_sessions) + " sessions: " +
+					  ", ".join(phase + " " + str(round(best[phase], 4)) + "s" for phase in PHASES))
+	finally:
+		shutil.rmtree(work_dir)
+	return {
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"seed": seed,
+		"skew": skew,
+		"capacity_ratio": capacity_ratio,
+		"presort": presort,
+		"repeat": repeat,
+		"results": results,
+	}
+
+
+def compare(report, baseline, threshold):
+	"""
+	Prints each phase's time relative to a baseline report
+	:param threshold: relative slowdown above which a phase counts as a regression, e.g. 0.2 for 20%
+	:return: list of (students, sessions, phase, ratio) regressions
+	"""
+	baseline_results = dict(((result["students"], result["sessions"]), result["seconds"])
+							for result in baseline["results"])
+	regressions = []
+	for result in report["results"]:
+		size = (result["students"], result["sessions"])
+		if size not in baseline_results:
+			continue
+		print("### " + str(size[0]) + " students x " + str(size[1]) + " sessions ###")
+		for phase in PHASES:
+			before = baseline_results[size].get(phase)
+			after = result["seconds"].get(phase)
+			if not before or after is None:
+				continue
+			ratio = after / before
+			flag = " REGRESSION" if ratio > 1 + threshold else ""
+			print(phase.rjust(16) + ": " + str(round(before, 4)).rjust(9) + "s -> " + str(round(after, 4)).rjust(9) +
+				  "s (x" + str(round(ratio, 2)) + ")" + flag)
+			if flag:
+				regressions.append((size[0], size[1], phase, ratio))
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the phases of SmartMatch and IndexedMatch over synthetic " +
+												 "inputs.")
+	parser.add_argument("-v", "--verbose", help="output timings to console as they are measured", action="store_true")
+	parser.add_argument("--sizes", help="comma-separated STUDENTSxSESSIONS sizes (default 1000x10,10000x100,100000x500)",
+						default="1000x10,10000x100,100000x500")
+	parser.add_argument("--seed", help="seed of the synthetic inputs (default 0)", type=int, default=0)
+	parser.add_argument("--skew", help="Zipf exponent of session popularity (default 1.0)", type=float, default=1.0)
+	parser.add_argument("--capacity", help="total spaces over number of students (default 1.0)", type=float,
+						default=1.0)
+	parser.add_argument("--presort", help="top n choices to pre-sort on (default 1)", type=int, default=1)
+	parser.add_argument("--repeat", help="keep the fastest of REPEAT runs per size (default 3)", type=int, default=3)
+	parser.add_argument("--compare", help="baseline json report to compare against")
+	parser.add_argument("--threshold", help="relative slowdown reported as a regression (default 0.2)", type=float,
+						default=0.2)
+	parser.add_argument("output_json", help="name of the json report to write (relative path)")
+	args = parser.parse_args()
+
+	report = run_benchmarks(parse_sizes(args.sizes), args.seed, args.skew, args.capacity, args.presort, args.repeat,
+							args.verbose)
+	with open(args.output_json, 'w') as write_file:
+		json.dump(report, write_file, indent=2, sort_keys=True)
+	if args.compare:
+		with open(args.compare, 'r') as read_file:
+			regressions = compare(report, json.load(read_file), args.threshold)
+		if regressions:
+			sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
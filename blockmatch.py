@@ -0,0 +1,129 @@
+#!/usr/bin/python
+
+"""Matches students into one session per time block, for events held over several blocks, in one run"""
+
+# local imports
+from indexedmatch import IndexedMatch, grade_worklist
+
+
+class BlockMatch(IndexedMatch):
+	def __init__(self, arrays, students):
+		"""
+		IndexedMatch over an input held in several time blocks: every student attends one session in every block,
+		taken from their one list of choices, and never the same session twice
+		:param arrays: MatchArrays of the parsed input, with the capacity of every block
+		:param students: student indices, in the order they are first considered
+		"""
+		super(BlockMatch, self).__init__(arrays, students)
+		num_blocks = arrays.get_num_blocks()
+		# spaces left per session and block, flattened session by session
+		self.space = [capacity[session] for session in range(arrays.get_num_sessions())
+					  for capacity in arrays.block_capacity]
+		# per block: (session index, choice) per student; -1 and past the last choice for students without one
+		self.placements = [[(-1, choices) for choices in arrays.num_choices] for _ in range(num_blocks)]
+
+	def match(self):
+		"""
+		Places the students one after another, highest grade first and in the order they are considered within
+		a grade, as grade_worklist orders them: every student goes down their choices and takes each session that
+		still fits next to the ones they took, until they have one in every block. A session fits if the sessions
+		taken so far can all be held in different blocks with space, which is decided by an augmenting path search
+		over the few blocks. As no student is displaced, the students of a higher grade are never passed over for
+		one of a lower grade, as in IndexedMatch.match, and the seed picks who goes first within a grade.
+		:return: sum of the grades of unassigned students, once for every block they have no session in
+		"""
+		grades = self.arrays.grades
+		num_choices = self.arrays.num_choices
+		choices = self.arrays.choices
+		width = self.arrays.width
+		num_blocks = self.arrays.get_num_blocks()
+		profile = self.profile
+		names = self.arrays.session_names
+		worklist = grade_worklist(self.students, grades.__getitem__)
+		self.students = []
+		match_success = 0
+		for grade in sorted(worklist, reverse=True):
+			for student in worklist[grade]:
+				row = student * width
+				# sessions taken, their choice, and the index into them held in every block
+				taken = []
+				prefs = []
+				block_of = {}
+				for pref in range(num_choices[student]):
+					if len(taken) == num_blocks:
+						break
+					session = choices[row + pref]
+					if session < 0:
+						if profile:
+							profile.count("unknown_sessions")
+						continue
+					if session in taken:
+						continue
+					if profile:
+						profile.count("proposals", names[session])
+					taken.append(session)
+					if self._augment(taken, len(taken) - 1, block_of, set([])):
+						prefs.append(pref)
+					else:
+						taken.pop()
+						if profile:
+							profile.count("rejections", names[session])
+				for block, index in block_of.items():
+					self.space[taken[index] * num_blocks + block] -= 1
+					self.placements[block][student] = (taken[index], prefs[index])
+				if len(taken) < num_blocks:
+					self.unassigned.append(student)
+					match_success += grades[student] * (num_blocks - len(taken))
+		return match_success
+
+	def _augment(self, taken, index, block_of, visited):
+		"""
+		Finds a block for session TAKEN[INDEX], moving the sessions already held in blocks to others if need be,
+		trying the blocks with the most space left first
+		:param taken: session indices
+		:param block_of: dictionary of the index into TAKEN held in every block, updated on success
+		:param visited: blocks already tried in this search
+		:return: whether a block was found
+		"""
+		num_blocks = len(self.placements)
+		start = taken[index] * num_blocks
+		space = self.space[start:start + num_blocks]
+		for block in sorted(range(num_blocks), key=lambda block: -space[block]):
+			if space[block] <= 0 or block in visited:
+				continue
+			visited.add(block)
+			if block not in block_of or self._augment(taken, block_of[block], block_of, visited):
+				block_of[block] = index
+				return True
+		return False
+
+	def prematch(self, top_n):
+		raise ValueError("students held in several time blocks cannot be pre-sorted")
+
+	def assignment(self):
+		"""
+		:return: block assignment vector: per student index, the (session index, current choice) of every block;
+				 session index is -1 in the blocks a student has no session in
+		"""
+		return list(zip(*self.placements))
+
+
+def block_bound(arrays):
+	"""
+	Lower bound on the result of BlockMatch.match, as capacity_bound is for one block: a student who chose fewer
+	existing sessions than there are blocks leaves the other blocks empty, and there is no room for the sessions
+	students could take beyond the total capacity of all blocks
+	:param arrays: MatchArrays of the input
+	:return: the sum of both bounds
+	"""
+	num_blocks = arrays.get_num_blocks()
+	unplaceable = 0
+	grades = []
+	for student in range(arrays.get_num_students()):
+		grade = arrays.grades[student]
+		taken = min(len(arrays.known_choices(student)), num_blocks)
+		unplaceable += grade * (num_blocks - taken)
+		grades.extend([grade] * taken)
+	excess = len(grades) - sum(arrays.capacity)
+	over_total = sum(sorted(grades)[:excess]) if excess > 0 else 0
+	return unplaceable + over_total
@@ -0,0 +1,261 @@
+#!/usr/bin/python
+
+"""Loads the classes and students csv files in one pass each, straight into the columns of a MatchArrays"""
+
+# native imports
+from array import array
+import csv
+import io
+from itertools import compress, islice, repeat
+import operator
+
+# local imports
+from indexedmatch import MatchArrays, choice_array
+
+# number of line numbers kept per kind of malformed row
+EXAMPLES = 5
+# cell filling out the choices of students with fewer than the most choices
+PADDING = None
+
+
+class LoadReport:
+	def __init__(self):
+		"""
+		Malformed rows and unknown session names found while loading, reported in aggregate instead of per row
+		"""
+		# problem: [number of rows, first line numbers]
+		self.malformed = {}
+		self.unknown_sessions = set([])
+		self.unknown_choices = 0
+		# SID -> tuple of (choice position, session name) of the choices of sessions missing from the classes file
+		self.unknown_cells = {}
+
+	def add(self, problem, filename, line_number):
+		key = filename + ": " + problem
+		if key not in self.malformed:
+			self.malformed[key] = [0, []]
+		self.malformed[key][0] += 1
+		if len(self.malformed[key][1]) < EXAMPLES:
+			self.malformed[key][1].append(line_number)
+
+	def has_problems(self):
+		return bool(self.malformed or self.unknown_choices)
+
+	def __str__(self):
+		lines = []
+		for key in sorted(self.malformed):
+			count, line_numbers = self.malformed[key]
+			lines.append(key + ": " + str(count) + " row(s) skipped, e.g. line " +
+						 ", ".join(str(line_number) for line_number in line_numbers))
+		if self.unknown_choices:
+			lines.append(str(self.unknown_choices) + " choice(s) of sessions missing from the classes file: " +
+						 ", ".join(repr(name) for name in sorted(self.unknown_sessions)))
+		return "\n".join(lines)
+
+
+class _SessionIndex(dict):
+	def __init__(self, session_index, integer_class_names, report):
+		"""
+		Interns raw choice cells to session indices, converting and validating each distinct cell only once
+		"""
+		super(_SessionIndex, self).__init__()
+		self.session_index = session_index
+		self.class_numbers = integer_class_names
+		self.report = report
+		self[PADDING] = -1
+
+	def __missing__(self, cell):
+		name = choice_name(cell, self.class_numbers)
+		index = self.session_index.get(name, -1)
+		if index < 0:
+			self.report.unknown_sessions.add(name)
+		self[cell] = index
+		return index
+
+
+def choice_name(cell, integer_class_names):
+	"""
+	:return: the session name a choice cell refers to, normalized as SmartStudent and define_students do
+	"""
+	if integer_class_names:
+		try:
+			return str(int(cell))
+		except ValueError:
+			pass
+	return cell.strip().lower()
+
+
+def read_text(filename):
+	"""
+	:return: the whole text of FILENAME, without the byte order mark spreadsheet programs put in front of csv exports
+	"""
+	with open(filename, 'rb') as read_file:
+		return read_file.read().decode("utf-8-sig")
+
+
+def read_rows(filename):
+	"""
+	Reads a whole csv file at once; files without quoted fields are split directly instead of through csv.reader
+	:return: list of rows, each a list of cells
+	"""
+	text = read_text(filename)
+	if '"' in text:
+		return list(csv.reader(io.StringIO(text, newline='')))
+	return [line.split(",") for line in text.splitlines()]
+
+
+def _is_integer(cell):
+	try:
+		int(cell)
+	except ValueError:
+		return False
+	return True
+
+
+def _split_sorted(lines):
+	"""
+	Fast path for student files whose lines all have the same number of cells, no quotes, no repeated SIDs and
+	only valid grades: the lines are sorted and split into cells with a handful of calls over the whole file
+	:param lines: lines of the student file, without the header
+	:return: (SIDs, grades, number of choices, width, flattened choice cells) in canonical order, or None
+	"""
+	if not lines:
+		return None
+	num_cells = lines[0].count(",") + 1
+	if num_cells < 2 or set(map(str.count, lines, repeat(","))) != {num_cells - 1}:
+		return None
+	# lines sort like their SIDs unless a SID holds a character that sorts before ','; strictly increasing SIDs
+	# also rule out repeats
+	lines.sort()
+	cells = ",".join(lines).split(",")
+	sids = cells[0::num_cells]
+	if not all(map(operator.lt, sids, islice(sids, 1, None))):
+		return None
+	try:
+		grades = array('h', map(int, cells[1::num_cells]))
+	except (ValueError, OverflowError):
+		return None
+	del cells[0::num_cells]
+	del cells[0::num_cells - 1]
+	width = num_cells - 2
+	return sids, grades, array('b', [width]) * len(sids), width, cells
+
+
+def _split_rows(rows, filename, report):
+	"""
+	Row by row counterpart of _split_sorted, which skips and reports malformed rows and repeated SIDs
+	:return: (SIDs, grades, number of choices, width, flattened choice cells padded with '') in canonical order
+	"""
+	kept = []
+	seen = set([])
+	for line_number, row in enumerate(rows, 1):
+		if not any(row):
+			continue
+		try:
+			int(row[1])
+		except (IndexError, ValueError):
+			if line_number > 1:  # the first line may be a header
+				report.add("missing or non-integer grade", filename, line_number)
+			continue
+		if row[0] in seen:
+			report.add("repeated SID", filename, line_number)
+			continue
+		seen.add(row[0])
+		kept.append(row)
+	kept.sort(key=lambda row: row[0])
+	width = max([len(row) for row in kept] + [2]) - 2
+	cells = []
+	for row in kept:
+		cells.extend(row[2:])
+		cells.extend([PADDING] * (width + 2 - len(row)))
+	return ([row[0] for row in kept], array('h', [int(row[1]) for row in kept]),
+			array('b', [len(row) - 2 for row in kept]), width, cells)
+
+
+def class_spaces(row, num_blocks=1):
+	"""
+	Reads the numbers of spaces of one row of the classes file, as every tool reading the file does. Only the
+	first NUM_BLOCKS numbers are spaces, so any further columns, e.g. a room number, are left alone.
+	:param row: row of the classes file: CLASSNAME, NUM_SPACES[, NUM_SPACES_2, ...]
+	:param num_blocks: number of time blocks the classes are held in
+	:return: list of the number of spaces in every block; a blank or missing number in a later block is 0
+	:raise IndexError, ValueError: if the row has no number of spaces, or one is not an integer
+	"""
+	spaces = [int(row[1])]
+	for cell in row[2:num_blocks + 1]:
+		spaces.append(int(cell) if cell.strip() else 0)
+	spaces.extend([0] * (num_blocks - len(spaces)))
+	return spaces
+
+
+def load_sessions(filename, report, num_blocks=1):
+	"""
+	Reads the classes file as define_sessions does, see class_spaces
+	:param filename: class data in csv format, one class per line:
+					 CLASSNAME, NUM_SPACES[, NUM_SPACES_2, ...]
+	:param report: LoadReport to record malformed rows in
+	:param num_blocks: number of time blocks the classes are held in
+	:return: dictionary of the list of the number of spaces in every block keyed by session name, for sessions
+			 with space in any block
+	"""
+	spaces = {}
+	for line_number, row in enumerate(read_rows(filename), 1):
+		if not any(row):
+			continue
+		try:
+			space = class_spaces(row, num_blocks)
+		except (IndexError, ValueError):
+			if line_number > 1:  # the first line may be a header
+				report.add("missing or non-integer number of spaces", filename, line_number)
+			continue
+		name = row[0].strip().lower()
+		if sum(space) > 0:
+			spaces[name] = space
+	return spaces
+
+
+def load_arrays(classes_csv, students_csv, integer_class_names, num_blocks=1):
+	"""
+	Loads both input files into a MatchArrays without building a SmartStudent or SmartSession per row.
+	Students are kept in canonical (SID) order and their choices are interned to session indices up front;
+	rows with a missing or non-integer grade and repeated SIDs are skipped and reported.
+	:param classes_csv: class data in csv format, one class per line:
+						CLASSNAME, NUM_SPACES[, NUM_SPACES_2, ...]
+	:param students_csv: student data in csv format, one student per line:
+						 SID, GRADE_LEVEL, CHOICE_1, CHOICE_2, CHOICE_3, CHOICE_4, CHOICE_5
+	:param integer_class_names: classes are integer numbered instead of named
+	:param num_blocks: number of time blocks the classes are held in, each with its own number of spaces
+	:return: MatchArrays of the input, and the LoadReport of problems found
+	"""
+	report = LoadReport()
+	spaces = load_sessions(classes_csv, report, num_blocks)
+	session_names = sorted(spaces.keys())
+	session_index = _SessionIndex(dict((name, index) for index, name in enumerate(session_names)),
+								  integer_class_names, report)
+
+	text = read_text(students_csv)
+	lines = text.splitlines()
+	if lines and not _is_integer((lines[0].split(",") + [""])[1]):
+		del lines[0]  # header
+	columns = None if '"' in text else _split_sorted(lines)
+	del text, lines
+	if columns is None:
+		columns = _split_rows(read_rows(students_csv), students_csv, report)
+	sids, grades, num_choices, width, cells = columns
+	choices = choice_array(len(session_names))
+	# filling the array from a list is much faster than from an iterator
+	choices.fromlist(list(map(session_index.__getitem__, cells)))
+	if report.unknown_sessions:
+		report.unknown_choices = choices.count(-1) - (width * len(sids) - sum(num_choices))
+	if report.unknown_choices:
+		for cell in compress(range(len(choices)), map((-1).__eq__, choices)):
+			student, pref = divmod(cell, width)
+			if pref < num_choices[student]:
+				name = choice_name(cells[cell], integer_class_names)
+				report.unknown_cells[sids[student]] = report.unknown_cells.get(sids[student], ()) + ((pref, name),)
+
+	blocks = [array('i', [spaces[name][block] for name in session_names]) for block in range(num_blocks)]
+	capacity = array('i', map(sum, zip(*blocks))) if num_blocks > 1 else blocks[0]
+	arrays = MatchArrays(session_names, capacity, sids, grades, num_choices, width, choices,
+						 blocks if num_blocks > 1 else None)
+	return arrays, report
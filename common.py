@@ -1,5 +1,11 @@
 #!/usr/bin/python
 
+# native imports
+import itertools
+import multiprocessing
+import time
+
+
 def choice_str(choice):
 	try:
 		num = int(choice)
@@ -22,4 +28,131 @@ def sum_dictionary(dict):
 			sum += int(dict[key])
 		except ValueError:
 			continue
-	return sum
\ No newline at end of file
+	return sum
+
+
+# width of the order of registration below the grade in a priority_key
+ORDER_BITS = 32
+
+
+def priority_key(grade):
+	"""
+	Packs the priority of a student in a session into one integer, so that rosters are heaps of plain ints and
+	every comparison runs at C speed: grade first, then the order of registration, which the session adds to the
+	key as the student registers. Order counters count down from 0, so of two students with the same grade the one
+	registered first ranks higher. The higher of two keys has priority.
+	:param grade: grade level
+	:return: key to add an order counter to, which must stay above -2 ** ORDER_BITS
+	"""
+	return grade << ORDER_BITS
+
+
+def derive_seed(seed, iteration):
+	"""
+	:return: the seed of iteration ITERATION of a search seeded with SEED
+	"""
+	return seed * 1000003 + iteration
+
+
+def chunk_ranges(iterations, workers, first=0):
+	"""
+	Splits iterations FIRST to ITERATIONS into (start, stop) ranges, small enough to keep WORKERS processes busy
+	"""
+	chunk_size = max(1, (iterations - first) // (workers * 8)) if workers > 1 else 1
+	return [(start, min(start + chunk_size, iterations)) for start in range(first, iterations, chunk_size)]
+
+
+def iteration_ranges(iterations, workers, first=0):
+	"""
+	Same as chunk_ranges, but endless if ITERATIONS is None
+	:return: iterator of (start, stop) ranges
+	"""
+	if iterations is not None:
+		return iter(chunk_ranges(iterations, workers, first))
+	chunk_size = 4 if workers > 1 else 1
+	return ((start, start + chunk_size) for start in itertools.count(first, chunk_size))
+
+
+def in_order(results, first=0):
+	"""
+	Puts the results of contiguous (start, stop) ranges, which arrive in order of completion, back in range order
+	:param results: tuples starting with the START and STOP of their range; the first range starts at FIRST
+	:return: generator of results, in order of START
+	"""
+	pending = {}
+	start = first
+	for result in results:
+		pending[result[0]] = result
+		while start in pending:
+			result = pending.pop(start)
+			start = result[1]
+			yield result
+
+
+class SearchBudget:
+	def __init__(self, time_limit=None, patience=None, bound=None):
+		"""
+		Decides when a search of random restarts stops before its last iteration. Iterations are taken in order,
+		so apart from the time limit the stopping point and the result do not depend on the number of workers.
+		:param time_limit: seconds after which no new iteration is started
+		:param patience: stop once PATIENCE iterations in a row did not improve on the best result
+		:param bound: lower bound on the result; the first iteration reaching it ends the search
+		"""
+		self.deadline = None if time_limit is None else time.time() + time_limit
+		self.patience = patience
+		self.bound = bound
+		# (result, iteration) of the best iteration taken so far, of every iteration that improved on the ones
+		# before it, and the number of iterations taken
+		self.best = None
+		self.records = []
+		self.iterations = 0
+
+	def expired(self):
+		return self.deadline is not None and time.time() >= self.deadline
+
+	def reached(self, result):
+		return self.bound is not None and result <= self.bound
+
+	def take(self, records, stop, planned_stop):
+		"""
+		Takes the next range of iterations of the search
+		:param records: (result, iteration) of every iteration of the range that improved on the earlier ones
+						in the range, in order
+		:param stop: iteration after the last one run in the range
+		:param planned_stop: iteration the range was meant to stop at; runs stop short once the time is up
+		:return: True if the search ends in this range
+		"""
+		for result, iteration in records:
+			if self._exhausted(iteration):
+				return True
+			if self.best is None or result < self.best[0]:
+				self.best = (result, iteration)
+				self.records.append(self.best)
+				if self.reached(result):
+					self.iterations = iteration + 1
+					return True
+		self.iterations = stop
+		return self._exhausted(stop) or stop < planned_stop
+
+	def _exhausted(self, iteration):
+		# out of patience before ITERATION runs; the search then ends after the last iteration it was allowed
+		if self.patience is None or self.best is None or iteration - self.best[1] <= self.patience:
+			return False
+		self.iterations = self.best[1] + self.patience + 1
+		return True
+
+
+def map_chunks(function, chunks, workers=1, initializer=None, initargs=()):
+	"""
+	Applies FUNCTION to every chunk, over a pool of WORKERS processes if more than one
+	:param initializer: called with INITARGS once per process before any chunk is run
+	:return: generator of results, in order of completion
+	"""
+	if workers > 1:
+		with multiprocessing.Pool(workers, initializer, initargs) as pool:
+			yield from pool.imap_unordered(function, chunks)
+	else:
+		if initializer:
+			initializer(*initargs)
+		for chunk in chunks:
+			yield function(chunk)
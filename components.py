@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+"""Splits a matching into independent components: groups of students and the sessions only they chose"""
+
+# native imports
+from array import array
+from itertools import compress, groupby
+
+# local imports
+from indexedmatch import MatchArrays, choice_array
+
+
+class Component:
+	def __init__(self, students, sessions, source):
+		"""
+		One connected component of the graph between students and the sessions they chose. No student outside
+		the component chose one of its sessions, so it can be matched on its own.
+		:param students: student indices into SOURCE, in canonical order
+		:param sessions: session indices into SOURCE, in canonical order
+		:param source: MatchArrays of the whole input
+		"""
+		self.students = students
+		self.sessions = sessions
+		self.source = source
+		self.arrays = None
+
+	def get_arrays(self):
+		"""
+		:return: MatchArrays of just the component, built on first use; student and session i of it are
+				 students[i] and sessions[i], and every student keeps their row of choices, so current choices
+				 carry over
+		"""
+		if self.arrays is None:
+			self.arrays = _sub_arrays(self.source, self.students, self.sessions)
+		return self.arrays
+
+
+def find_components(arrays, block_size=1 << 16):
+	"""
+	Finds the connected components of the graph between students and the sessions they chose, by union-find
+	over the distinct pairs of sessions chosen by the same student. The pairs are found column by column over
+	blocks of rows of the choices matrix, and stop being collected once all sessions are connected, as they
+	soon are in large inputs with a single component.
+	:param arrays: MatchArrays of the input
+	:param block_size: number of students whose pairs are collected at a time
+	:return: list of Components, largest first; students who chose no existing session are in none of them
+	"""
+	num_sessions = arrays.get_num_sessions()
+	num_students = arrays.get_num_students()
+	width = arrays.width
+	parent = list(range(num_sessions))
+
+	def find(session):
+		while parent[session] != session:
+			parent[session] = parent[parent[session]]
+			session = parent[session]
+		return session
+
+	chosen = set(arrays.choices)
+	chosen.discard(-1)
+	num_roots = len(chosen)
+	for begin in range(0, num_students, block_size):
+		if num_roots <= 1:
+			break
+		rows = arrays.choices[begin * width:(begin + block_size) * width]
+		columns = [rows[pref::width] for pref in range(width)]
+		# a session of every student among their choices so far, or -1: any will do, as all of a student's
+		# sessions end up connected
+		earlier = columns[0] if columns else []
+		for column in columns[1:]:
+			for first, second in set(zip(earlier, column)):
+				if first >= 0 and second >= 0:
+					first, second = find(first), find(second)
+					if first != second:
+						parent[second] = first
+						num_roots -= 1
+			earlier = list(map(max, earlier, column))
+	# root of every session; the trailing -1 is what -1 (unknown, padding) reads
+	roots = [find(session) for session in range(num_sessions)] + [-1]
+	# all sessions of a student share a root, so the largest root in their row is that root, or -1 if none
+	student_roots = [-1] * num_students
+	for pref in range(width):
+		student_roots = list(map(max, student_roots, map(roots.__getitem__, arrays.choices[pref::width])))
+
+	sessions_by_root = {}
+	for session in sorted(chosen):
+		sessions_by_root.setdefault(roots[session], []).append(session)
+	if len(sessions_by_root) == 1:
+		root, sessions = sessions_by_root.popitem()
+		return [Component(list(compress(range(num_students), map(root.__eq__, student_roots))), sessions, arrays)]
+	components = []
+	ordered = sorted(range(num_students), key=student_roots.__getitem__)
+	for root, students in groupby(ordered, key=student_roots.__getitem__):
+		if root >= 0:
+			components.append(Component(list(students), sessions_by_root[root], arrays))
+	components.sort(key=lambda component: (-len(component.students), component.sessions[0]))
+	return components
+
+
+def _sub_arrays(arrays, students, sessions):
+	"""
+	:return: MatchArrays of STUDENTS and SESSIONS only, with session indices renumbered within SESSIONS
+	"""
+	# index of every session within SESSIONS; sessions outside it are never chosen by STUDENTS
+	local = [-1] * (arrays.get_num_sessions() + 1)
+	for index, session in enumerate(sessions):
+		local[session] = index
+	width = arrays.width
+	choices = choice_array(len(sessions))
+	for student in students:
+		choices.extend(map(local.__getitem__, arrays.choices[student * width:student * width + width]))
+	return MatchArrays([arrays.session_names[session] for session in sessions],
+					   array('i', [arrays.capacity[session] for session in sessions]),
+					   [arrays.sids[student] for student in students],
+					   array('h', [arrays.grades[student] for student in students]),
+					   array('b', [arrays.num_choices[student] for student in students]), width, choices)
+
+
+def merge_assignments(arrays, components, assignments):
+	"""
+	Puts the assignment vectors of the components back together
+	:param arrays: MatchArrays of the input
+	:param components: Components from find_components
+	:param assignments: assignment vector of (session index, current choice) of each component, within it
+	:return: assignment vector of (session index, current choice) per student of the input; students in no
+			 component are unassigned, past their last choice
+	"""
+	vector = [(-1, choices) for choices in arrays.num_choices]
+	for component, assignment in zip(components, assignments):
+		for student, (session, choice) in zip(component.students, assignment):
+			vector[student] = (-1 if session < 0 else component.sessions[session], choice)
+	return vector
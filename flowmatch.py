@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+# native imports
+import heapq
+
+# local imports
+from smartmatch import SmartMatch
+
+
+class FlowMatch(SmartMatch):
+	"""
+	Finds a provably optimal assignment in one pass by solving the matching as a min-cost flow:
+	every student is one unit of supply, every session a sink of its capacity, and a student may also flow
+	to an uncapacitated UNASSIGNED sink at a penalty. Students are routed one at a time along shortest paths
+	(successive shortest paths with potentials), so each step keeps the assignment optimal for the students
+	routed so far.
+
+	The flow graph is kept on sessions rather than students: moving a student from session A to session B
+	is an edge A -> B whose cost is the cheapest such move among A's students, found in a heap per (A, B).
+	"""
+	# the optimum does not depend on the order students are considered in, so one matching is the whole search
+	single_pass = True
+
+	def match(self):
+		"""
+		Minimizes the total grade of unassigned students (the result SmartMatch.match reports), then the
+		sum over placed students of choice rank weighted by grade.
+		:return: sum of the grades of unassigned students
+		"""
+		students = list(self.students)
+		for session in self.sessions.values():
+			students.extend(session.get_students())
+			session.reset()
+		students.extend(self.unassigned)
+		self.students = []
+		self.unassigned = set([])
+
+		names = sorted(self.sessions.keys())
+		session_index = dict((name, index) for index, name in enumerate(names))
+		unassigned_node = len(names)
+		space = [self.sessions[name].get_space() for name in names]
+		fill = [0] * len(names)
+
+		# (session index, rank) per student, first occurrence of each known session only
+		options = []
+		for student in students:
+			student_options = []
+			seen = set([])
+			for rank, choice in enumerate(student.choices):
+				index = session_index.get(choice)
+				if index is not None and index not in seen:
+					seen.add(index)
+					student_options.append((index, rank))
+			options.append(student_options)
+
+		# an unassigned student must cost more than any possible total of placement costs
+		max_rank = max([len(student.choices) for student in students] + [1]) - 1
+		max_grade = max([student.grade for student in students] + [1])
+		penalty = max_rank * max_grade * len(students) + 1
+		unassigned_cost = [student.grade * penalty for student in students]
+
+		location = [None] * len(students)
+		version = [0] * len(students)
+		potential = [0] * (len(names) + 1)
+		# (A, B) -> heap of (cost of moving a student from A to B, student, version)
+		moves = {}
+		targets = [set([]) for _ in names]
+		# cheapest move out of each session, as a list of (target, cost, student); None once out of date
+		out_edges = [None] * len(names)
+
+		def place(s, node, cost):
+			if location[s] is not None and location[s] != unassigned_node:
+				out_edges[location[s]] = None
+			location[s] = node
+			version[s] += 1
+			if node == unassigned_node:
+				return
+			out_edges[node] = None
+			for target, rank in options[s]:
+				if target != node:
+					edge = (node, target)
+					if edge not in moves:
+						moves[edge] = []
+						targets[node].add(target)
+					heapq.heappush(moves[edge], (rank * students[s].grade - cost, s, version[s]))
+			edge = (node, unassigned_node)
+			if edge not in moves:
+				moves[edge] = []
+				targets[node].add(unassigned_node)
+			heapq.heappush(moves[edge], (unassigned_cost[s] - cost, s, version[s]))
+
+		def cheapest_moves(node):
+			if out_edges[node] is None:
+				cheapest = []
+				for target in targets[node]:
+					heap = moves[(node, target)]
+					while heap and (location[heap[0][1]] != node or version[heap[0][1]] != heap[0][2]):
+						heapq.heappop(heap)
+					if heap:
+						cheapest.append((target, heap[0][0], heap[0][1]))
+				out_edges[node] = cheapest
+			return out_edges[node]
+
+		for s in range(len(students)):
+			grade = students[s].grade
+			start_edges = [(index, rank * grade) for index, rank in options[s]]
+			start_edges.append((unassigned_node, unassigned_cost[s]))
+			start_potential = max(potential[node] - cost for node, cost in start_edges)
+
+			# Dijkstra on reduced costs until the first session with space, or UNASSIGNED, is settled
+			distance = {}
+			previous = {}
+			frontier = []
+			for node, cost in start_edges:
+				reduced = cost + start_potential - potential[node]
+				if reduced < distance.get(node, reduced + 1):
+					distance[node] = reduced
+					previous[node] = (None, s)
+					heapq.heappush(frontier, (reduced, node))
+			settled = []
+			done = set([])
+			terminal = None
+			while frontier:
+				dist, node = heapq.heappop(frontier)
+				if node in done:
+					continue
+				done.add(node)
+				settled.append(node)
+				if node == unassigned_node or fill[node] < space[node]:
+					terminal = node
+					break
+				base = dist + potential[node]
+				for target, cost, moved in cheapest_moves(node):
+					reduced = base + cost - potential[target]
+					if target not in distance or reduced < distance[target]:
+						distance[target] = reduced
+						previous[target] = (node, moved)
+						heapq.heappush(frontier, (reduced, target))
+
+			# shift each student along the path, back from the terminal
+			node = terminal
+			while node is not None:
+				source, moved = previous[node]
+				if node == unassigned_node:
+					place(moved, node, unassigned_cost[moved])
+				else:
+					rank = dict(options[moved])[node]
+					place(moved, node, rank * students[moved].grade)
+				node = source
+			if terminal != unassigned_node:
+				fill[terminal] += 1
+
+			# keep reduced costs non-negative for the next student
+			terminal_distance = distance[terminal]
+			for node in settled:
+				potential[node] += distance[node] - terminal_distance
+
+		match_success = 0
+		for s, student in enumerate(students):
+			student.reset()
+			if location[s] == unassigned_node:
+				student.current_choice = len(student.choices)
+				self.unassigned.add(student)
+				match_success += student.grade
+			else:
+				student.current_choice = dict(options[s])[location[s]]
+				self.sessions[names[location[s]]].register(student)
+		return match_success
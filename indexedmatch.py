@@ -0,0 +1,313 @@
+#!/usr/bin/python
+
+# native imports
+from array import array
+from collections import Counter, deque
+import heapq
+from itertools import chain, compress, filterfalse, repeat
+
+# local imports
+from common import priority_key
+
+
+class MatchArrays:
+	def __init__(self, session_names, capacity, sids, grades, num_choices, width, choices, block_capacity=None):
+		"""
+		Integer-indexed copy of the parsed students and sessions, stored as parallel arrays.
+		Session names are interned to their position in SESSION_NAMES and students to their position in SIDS.
+		:param session_names: session names, in canonical order
+		:param capacity: array of the number of spaces per session
+		:param sids: student ids, in canonical order
+		:param grades: array of grades per student
+		:param num_choices: array of the number of choices per student
+		:param width: largest number of choices of any student
+		:param choices: students x width matrix of session indices, flattened row by row;
+						-1 for unknown sessions and for padding
+		:param block_capacity: list of the array of the number of spaces per session in every time block, for
+							   inputs held over several blocks; CAPACITY is then their total
+		"""
+		self.session_names = list(session_names)
+		self.session_index = dict((name, index) for index, name in enumerate(self.session_names))
+		self.capacity = capacity
+		self.sids = sids
+		self.grades = grades
+		self.num_choices = num_choices
+		self.width = width
+		self.choices = choices
+		self.block_capacity = block_capacity if block_capacity is not None else [capacity]
+		# results of tally(), presort_targets(), priority_keys() and padded_choices(), which only depend on the input
+		self._tallies = None
+		self._presort_targets = {}
+		self._priority_keys = None
+		self._padded_choices = None
+
+	def get_num_students(self):
+		return len(self.sids)
+
+	def get_num_sessions(self):
+		return len(self.session_names)
+
+	def get_num_blocks(self):
+		return len(self.block_capacity)
+
+	def known_choices(self, student):
+		"""
+		:return: indices of the sessions STUDENT chose that exist, in order of preference, first occurrence only
+		"""
+		row = []
+		for session in self.choices[student * self.width:student * self.width + self.num_choices[student]]:
+			if session >= 0 and session not in row:
+				row.append(session)
+		return row
+
+	def choice_index(self, student, session):
+		"""
+		:return: position of SESSION among the choices of STUDENT, as kept in current_choice
+		"""
+		start = student * self.width
+		return self.choices[start:start + self.num_choices[student]].index(session)
+
+	def tally(self):
+		"""
+		:return: list of the total number of student votes per session, counted over the whole choices matrix once
+		"""
+		if self._tallies is None:
+			counts = Counter(self.choices)
+			self._tallies = [counts[session] for session in range(self.get_num_sessions())]
+		return self._tallies
+
+	def presort_targets(self, top_n):
+		"""
+		Finds the students prematch places: every session with space for all the top n votes it got takes the
+		students for whom it is the highest such session among their top n choices. Works on whole columns of the
+		choices matrix: the votes are counted column by column and the students are picked out of each column in
+		bulk, so per-student Python code only runs for the students who are placed. Computed once per TOP_N.
+		:param top_n: top n choices of each student to tally up
+		:return: array of the session index each student is placed in, -1 for students who are not, and
+				 bytearray of one past the preference they are placed at, 0 for students who are not
+		"""
+		if top_n not in self._presort_targets:
+			width = self.width
+			num_students = self.get_num_students()
+			# column of the matrix per preference: the session every student ranked there
+			columns = [self.choices[pref::width] for pref in range(0, min(top_n, width))]
+			top_n_tallies = Counter()
+			for column in columns:
+				top_n_tallies.update(column)
+			# 1 per session that takes its students; the trailing 0 is what -1 (unknown, padding) reads
+			pre_placement_sessions = bytearray(self.get_num_sessions() + 1)
+			for session, count in top_n_tallies.items():
+				if session >= 0 and self.capacity[session] >= count:
+					pre_placement_sessions[session] = 1
+			targets = array('i', [-1]) * num_students
+			placed = bytearray(num_students)
+			for pref, column in enumerate(columns):
+				for student in compress(range(num_students), map(pre_placement_sessions.__getitem__, column)):
+					if not placed[student]:
+						targets[student] = column[student]
+						placed[student] = pref + 1
+			self._presort_targets[top_n] = (targets, placed)
+		return self._presort_targets[top_n]
+
+	def priority_keys(self):
+		"""
+		:return: list of the priority_key of every student, computed once per input
+		"""
+		if self._priority_keys is None:
+			self._priority_keys = [priority_key(grade) for grade in self.grades]
+		return self._priority_keys
+
+	def padded_choices(self):
+		"""
+		:return: the choices matrix with one more column of -1 on the right, width + 1 wide, computed once per input;
+				 moving on past the last choice of a row reads -1 instead of the first choice of the next row
+		"""
+		if self._padded_choices is None:
+			columns = [self.choices[pref::self.width] for pref in range(self.width)]
+			columns.append(repeat(-1, self.get_num_students()))
+			self._padded_choices = array(self.choices.typecode, chain.from_iterable(zip(*columns)))
+		return self._padded_choices
+
+def index_students(students, session_names, sessions):
+	"""
+	:param students: SmartStudent objects, in canonical order
+	:param session_names: session names, in canonical order
+	:param sessions: dictionary of SmartSession objects keyed by session name
+	:return: MatchArrays of the students and sessions
+	"""
+	session_index = dict((name, index) for index, name in enumerate(session_names))
+	width = max([len(student.choices) for student in students] + [0])
+	choices = choice_array(len(session_names))
+	for student in students:
+		row = [session_index.get(choice, -1) for choice in student.choices]
+		choices.extend(row + [-1] * (width - len(row)))
+	return MatchArrays(session_names, array('i', [sessions[name].get_space() for name in session_names]),
+					   [student.get_id() for student in students], array('h', [student.grade for student in students]),
+					   array('b', [len(student.choices) for student in students]), width, choices)
+
+
+def grade_worklist(students, grade_of):
+	"""
+	Orders the free students of a matching: highest grade first, and first come, first served within a grade.
+	A student is only displaced by a student of a higher grade, so once every student of a higher grade has been
+	placed or turned down everywhere, the students of a grade propose without being displaced again, and the
+	only students sent back to the worklist are lower-grade students placed before the matching started.
+	Each grade's turn is then a serial dictatorship: its students, in order, take their best session with space
+	left, so no group of students of a grade all prefer each other's sessions.
+	:param students: free students, in the order they are first considered
+	:param grade_of: function giving the grade of a student
+	:return: dictionary of the deque of free students of every grade, keyed by grade
+	"""
+	worklist = {}
+	for student in students:
+		grade = grade_of(student)
+		if grade not in worklist:
+			worklist[grade] = deque()
+		worklist[grade].append(student)
+	return worklist
+
+
+def choice_array(num_sessions):
+	"""
+	:return: an empty array wide enough to hold session indices of NUM_SESSIONS sessions
+	"""
+	return array('h' if num_sessions < 2 ** 15 else 'i')
+
+
+class IndexedMatch:
+	# True for engines that find the same matching from every seed, as SmartMatch.single_pass
+	single_pass = False
+
+	def __init__(self, arrays, students):
+		"""
+		State of one matching over a MatchArrays, working on student and session indices only
+		:param arrays: MatchArrays of the parsed input
+		:param students: student indices, in the order they are first considered
+		"""
+		self.arrays = arrays
+		self.students = list(students)
+		self.unassigned = []
+		self.current_choice = array('i', bytes(4 * arrays.get_num_students()))
+		# per session: min-heap of (priority key + order, student); roster[0] is always the worst match, and keys
+		# are unique within a session, so students are never compared
+		self.rosters = [[] for _ in range(arrays.get_num_sessions())]
+		self.order_counters = [0] * arrays.get_num_sessions()
+		self.tallies = None
+		# optional MatchProfile counting the events of match()
+		self.profile = None
+
+	def register(self, session, student):
+		key = self.arrays.priority_keys()[student] + self.order_counters[session]
+		heapq.heappush(self.rosters[session], (key, student))
+		self.order_counters[session] -= 1
+		if self.profile:
+			self.profile.count("heap_operations", self.arrays.session_names[session])
+
+	def match(self):
+		"""
+		Performs the national medical school residency matching algorithm, as SmartMatch.match does, grade by
+		grade; see there for how its matchings differ from those of the earlier proposal order.
+		:return: sum of the grades of unassigned students
+		"""
+		grades = self.arrays.grades
+		keys = self.arrays.priority_keys()
+		num_choices = self.arrays.num_choices
+		choices = self.arrays.choices
+		width = self.arrays.width
+		capacity = self.arrays.capacity
+		current_choice = self.current_choice
+		rosters = self.rosters
+		order_counters = self.order_counters
+		profile = self.profile
+		names = self.arrays.session_names
+		worklist = grade_worklist(self.students, grades.__getitem__)
+		self.students = []
+		while worklist:
+			grade = max(worklist)
+			# drained rather than iterated: students displaced by this turn may join it
+			turn = worklist[grade]
+			while turn:
+				student = turn.popleft()
+				# the student proposes down their choices until a session keeps them
+				pref = current_choice[student]
+				row = student * width
+				priority = keys[student]
+				while pref < num_choices[student]:
+					session = choices[row + pref]
+					if session < 0:
+						if profile:
+							profile.count("unknown_sessions")
+						pref += 1
+						continue
+					if profile:
+						profile.count("proposals", names[session])
+					roster = rosters[session]
+					key = priority + order_counters[session]
+					if len(roster) < capacity[session]:
+						heapq.heappush(roster, (key, student))
+						order_counters[session] -= 1
+						if profile:
+							profile.count("heap_operations", names[session])
+						break
+					if key > roster[0][0]:
+						# replace the worst match with the current student, in one heap operation
+						worst_match = heapq.heapreplace(roster, (key, student))[1]
+						order_counters[session] -= 1
+						current_choice[worst_match] += 1
+						worklist.setdefault(grades[worst_match], deque()).append(worst_match)
+						if profile:
+							profile.count("displacements", names[session])
+							profile.count("heap_operations", names[session])
+						break
+					# the session keeps its worst match, which is only looked at
+					if profile:
+						profile.count("rejections", names[session])
+					pref += 1
+				current_choice[student] = pref
+				if pref >= num_choices[student]:
+					self.unassigned.append(student)
+			del worklist[grade]
+		# best = least number of higher-grade students left unmatched
+		match_success = 0
+		for student in self.unassigned:
+			match_success += grades[student]
+		return match_success
+
+	def prematch(self, top_n):
+		"""Pre-sort students into classes whose capacity is greater than
+			the total number of choices in the top n choices of each student, as SmartMatch.prematch does.
+			The students to place are found once per input by MatchArrays.presort_targets; each iteration only
+			registers them, in the order they are considered, and hands the rest to match().
+		:param top_n: top n choices of each student to tally up
+		:requires: no student has been registered yet
+		:return:
+		"""
+		targets, placed = self.arrays.presort_targets(top_n)
+		keys = self.arrays.priority_keys()
+		rosters = self.rosters
+		order_counters = self.order_counters
+		filled = set([])
+		for student in compress(self.students, map(placed.__getitem__, self.students)):
+			session = targets[student]
+			self.current_choice[student] = placed[student] - 1
+			rosters[session].append((keys[student] + order_counters[session], student))
+			order_counters[session] -= 1
+			filled.add(session)
+		# one heapify per session instead of a push per student
+		for session in filled:
+			heapq.heapify(rosters[session])
+			if self.profile:
+				self.profile.count("heap_operations", self.arrays.session_names[session], len(rosters[session]))
+		self.students = list(filterfalse(placed.__getitem__, self.students))
+		self.tallies = self.arrays.tally()
+
+	def assignment(self):
+		"""
+		:return: assignment vector of (session index, current choice) per student index;
+				 session index is -1 for unassigned students
+		"""
+		placement = [-1] * self.arrays.get_num_students()
+		for session, roster in enumerate(self.rosters):
+			for key, student in roster:
+				placement[student] = session
+		return [(placement[student], self.current_choice[student]) for student in range(len(placement))]
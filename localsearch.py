@@ -0,0 +1,328 @@
+#!/usr/bin/python
+
+"""Improves a finished matching with local moves instead of more random restarts"""
+
+# native imports
+from collections import deque
+
+
+class LocalSearch:
+	def __init__(self, arrays, assignment, max_chain=8):
+		"""
+		Local search over one matching, evaluated lexicographically as FlowMatch does: first the sum of the grades of
+		unassigned students (the result SmartMatch.match reports), then the sum over placed students of choice rank
+		weighted by grade. Every move is evaluated from the few students and session counters it touches.
+		Moves keep the grade priority every engine enforces: none is made that leaves a student, placed or not, below
+		a session they ranked higher that holds a student of a lower grade (a blocking pair). A matching from
+		IndexedMatch or SmartMatch has none, and has none after the search.
+		:param arrays: MatchArrays of the input
+		:param assignment: assignment vector of (session index, current choice) per student, from any engine
+		:param max_chain: most students moved on by one ejection chain
+		"""
+		self.arrays = arrays
+		self.max_chain = max_chain
+		num_sessions = arrays.get_num_sessions()
+		# known sessions per student, in order of preference
+		self.options = [arrays.known_choices(student) for student in range(arrays.get_num_students())]
+		self.placement = [index for index, choice in assignment]
+		self.fill = [0] * num_sessions
+		# session -> grade -> students, to find the lowest-grade members of a session
+		self.members = [{} for _ in range(num_sessions)]
+		# session X -> session Y -> students placed in X who also chose Y, and the same sets keyed Y -> X
+		self.movers = [{} for _ in range(num_sessions)]
+		self.sources = [{} for _ in range(num_sessions)]
+		# session -> grade -> number of students who ranked the session above their placement, or chose it and are
+		# unassigned
+		self.envy = [{} for _ in range(num_sessions)]
+		self.unassigned_grades = 0
+		self.rank_cost = 0
+		for student, session in enumerate(self.placement):
+			self.placement[student] = -1
+			self._count_envy(student, 1)
+			if session >= 0 and session in self.options[student]:
+				self._enter(student, session)
+			else:
+				# a placement the student did not choose is not kept
+				self.unassigned_grades += arrays.grades[student]
+		self.moves = 0
+		# ejection chain lengths of _distances, recomputed once out of date
+		self.distance = None
+
+	def rank(self, student, session):
+		return self.options[student].index(session)
+
+	def result(self):
+		"""
+		:return: sum of the grades of unassigned students
+		"""
+		return self.unassigned_grades
+
+	def assignment(self):
+		"""
+		:return: assignment vector of (session index, current choice) per student; current choice is the rank of
+				 the session among the student's choices, or one past the last choice for unassigned students
+		"""
+		vector = []
+		for student, session in enumerate(self.placement):
+			if session < 0:
+				vector.append((-1, self.arrays.num_choices[student]))
+			else:
+				vector.append((session, self.arrays.choice_index(student, session)))
+		return vector
+
+	def _enter(self, student, session):
+		grade = self.arrays.grades[student]
+		self._count_envy(student, -1)
+		self.placement[student] = session
+		self._count_envy(student, 1)
+		self.fill[session] += 1
+		self.members[session].setdefault(grade, set([])).add(student)
+		movers = self.movers[session]
+		for other in self.options[student]:
+			if other != session:
+				if other not in movers:
+					movers[other] = self.sources[other][session] = set([])
+				movers[other].add(student)
+		self.rank_cost += grade * self.rank(student, session)
+
+	def _leave(self, student):
+		session = self.placement[student]
+		grade = self.arrays.grades[student]
+		self._count_envy(student, -1)
+		self.placement[student] = -1
+		self._count_envy(student, 1)
+		self.fill[session] -= 1
+		self.members[session][grade].discard(student)
+		for other in self.options[student]:
+			if other != session:
+				self.movers[session][other].discard(student)
+		self.rank_cost -= grade * self.rank(student, session)
+
+	def _envied(self, student):
+		"""
+		:return: the sessions STUDENT ranked above their placement, or all they chose if unassigned
+		"""
+		session = self.placement[student]
+		options = self.options[student]
+		return options if session < 0 else options[:options.index(session)]
+
+	def _count_envy(self, student, delta):
+		grade = self.arrays.grades[student]
+		for session in self._envied(student):
+			envy = self.envy[session]
+			envy[grade] = envy.get(grade, 0) + delta
+
+	def _top_envy(self, session):
+		"""
+		:return: highest grade of the students who would rather be in SESSION, -1 if there are none
+		"""
+		return max([grade for grade, count in self.envy[session].items() if count] + [-1])
+
+	def _lowest(self, session):
+		"""
+		:return: lowest grade of the members of SESSION, None if it is empty
+		"""
+		grades = [grade for grade, members in self.members[session].items() if members]
+		return min(grades) if grades else None
+
+	def _blocking(self, student):
+		"""
+		:return: whether STUDENT is in a blocking pair: they hold a seat a student of a higher grade ranked above
+				 their own placement, or they ranked a session above their placement that holds a lower grade
+		"""
+		grade = self.arrays.grades[student]
+		if self.placement[student] >= 0 and self._top_envy(self.placement[student]) > grade:
+			return True
+		for session in self._envied(student):
+			lowest = self._lowest(session)
+			if lowest is not None and lowest < grade:
+				return True
+		return False
+
+	def _apply(self, moves):
+		"""
+		Makes MOVES, then takes them back if any of the students moved is left in a blocking pair. A blocking pair
+		only appears where a session takes in a student or a student moves down their choices, so checking the
+		students moved finds every pair the moves created.
+		:param moves: list of (student, session) moves, made in order; session -1 unplaces the student
+		:return: True if the moves were kept
+		"""
+		previous = [(student, self.placement[student]) for student, session in moves]
+		num_moves = self.moves
+		for student, session in moves:
+			if session < 0:
+				self.unplace(student)
+			else:
+				self.place(student, session)
+		if not any(self._blocking(student) for student, session in moves):
+			return True
+		for student, session in reversed(previous):
+			if session < 0:
+				self.unplace(student)
+			else:
+				self.place(student, session)
+		self.moves = num_moves
+		return False
+
+	def place(self, student, session):
+		"""
+		Moves STUDENT into SESSION, out of their current session if any
+		"""
+		if self.placement[student] >= 0:
+			self._leave(student)
+		else:
+			self.unassigned_grades -= self.arrays.grades[student]
+		self._enter(student, session)
+		self.moves += 1
+
+	def unplace(self, student):
+		self._leave(student)
+		self.unassigned_grades += self.arrays.grades[student]
+		self.moves += 1
+
+	def improve(self, max_passes=10):
+		"""
+		Applies improving moves until none is left or MAX_PASSES passes are done: ejection chains and bumps of
+		lower-grade students to place unassigned students, then moves and swaps of placed students to sessions
+		they ranked higher; moves that would leave a blocking pair are not made
+		:return: sum of the grades of unassigned students afterwards
+		"""
+		for _ in range(max_passes):
+			moves = self.moves
+			self.place_unassigned()
+			self.upgrade()
+			if self.moves == moves:
+				break
+		return self.result()
+
+	def place_unassigned(self):
+		"""
+		Places unassigned students, highest grade first, by an ejection chain ending in spare capacity, or else by
+		bumping the lowest-grade student below them out of one of their sessions; bumped students are tried in turn
+		"""
+		grades = self.arrays.grades
+		waiting = [student for student, session in enumerate(self.placement) if session < 0 and self.options[student]]
+		waiting.sort(key=lambda student: (-grades[student], student))
+		self.distance = None
+		queue = deque(waiting)
+		while queue:
+			student = queue.popleft()
+			if self.placement[student] >= 0 or self.eject_chain(student):
+				continue
+			bumped = self.bump(student)
+			if bumped is not None:
+				queue.append(bumped)
+
+	def eject_chain(self, student):
+		"""
+		Places STUDENT by the shortest ejection chain: STUDENT enters one of their sessions, a member of that session
+		moves on to another session they chose, and so on until a session with spare capacity. Chains that would
+		leave a blocking pair are not made.
+		:return: True if a chain was found and applied
+		"""
+		if self.distance is None:
+			self.distance = self._distances()
+		distance = self.distance
+		reachable = [session for session in self.options[student] if distance[session] is not None]
+		reachable.sort(key=lambda session: distance[session])
+		for session in reachable:
+			if self._top_envy(session) > self.arrays.grades[student]:
+				continue
+			moves = self._descend(session)
+			if moves is not None and self._apply(list(reversed(moves)) + [(student, session)]):
+				return True
+		return False
+
+	def _distances(self):
+		"""
+		:return: per session, the length of the shortest ejection chain from that session to spare capacity, up to
+				 max_chain; None for sessions with no such chain
+		"""
+		capacity = self.arrays.capacity
+		distance = [None] * len(self.fill)
+		queue = deque()
+		for session in range(len(self.fill)):
+			if self.fill[session] < capacity[session]:
+				distance[session] = 0
+				queue.append(session)
+		while queue:
+			session = queue.popleft()
+			if distance[session] >= self.max_chain:
+				continue
+			for source, movers in self.sources[session].items():
+				if movers and distance[source] is None:
+					distance[source] = distance[session] + 1
+					queue.append(source)
+		return distance
+
+	def _descend(self, session):
+		"""
+		Follows the distances from SESSION down to spare capacity, depth first. Sessions found to be dead ends, as
+		moves made since the distances were computed filled them up or took their movers away, are marked
+		unreachable until the next pass, so every session is tried at most once per pass.
+		:return: list of (student, session) moves carrying one student out of SESSION, or None if there is none
+		"""
+		distance = self.distance
+		if distance[session] == 0:
+			if self.fill[session] < self.arrays.capacity[session]:
+				return []
+		else:
+			grades = self.arrays.grades
+			options = self.options
+			for target, movers in self.movers[session].items():
+				if movers and distance[target] == distance[session] - 1:
+					# students no higher grade would rather see in TARGET instead
+					top_envy = self._top_envy(target)
+					allowed = [other for other in movers if grades[other] >= top_envy]
+					if not allowed:
+						continue
+					moves = self._descend(target)
+					if moves is not None:
+						# the cheapest student to move on, in grade-weighted rank
+						mover = min(allowed, key=lambda other: (
+							grades[other] * (options[other].index(target) - options[other].index(session)), other))
+						return [(mover, target)] + moves
+		distance[session] = None
+		return None
+
+	def bump(self, student):
+		"""
+		Places STUDENT as deferred acceptance would: in the session they ranked highest among those holding a student
+		of a lower grade, whose lowest-grade student is unplaced in turn
+		:return: the bumped student, or None if STUDENT outranks nobody in their sessions
+		"""
+		for session in self.options[student]:
+			grade = self._lowest(session)
+			if grade is not None and grade < self.arrays.grades[student]:
+				bumped = min(self.members[session][grade])
+				self.unplace(bumped)
+				self.place(student, session)
+				return bumped
+		return None
+
+	def upgrade(self):
+		"""
+		Moves placed students to a session they ranked higher, into spare capacity or by swapping with a student
+		of that session who gains at least as much weighted rank as they lose, unless the move leaves a blocking pair
+		"""
+		grades = self.arrays.grades
+		capacity = self.arrays.capacity
+		options = self.options
+		for student in range(len(self.placement)):
+			current = self.placement[student]
+			if current < 0 or options[student][0] == current:
+				continue
+			current_rank = options[student].index(current)
+			for target_rank, target in enumerate(options[student][:current_rank]):
+				if self.fill[target] < capacity[target]:
+					if self._apply([(student, target)]):
+						break
+					continue
+				gain = grades[student] * (current_rank - target_rank)
+				swaps = []
+				for other in self.movers[target].get(current, ()):
+					delta = grades[other] * (options[other].index(current) - options[other].index(target)) - gain
+					if delta < 0:
+						swaps.append((delta, other))
+				if any(self._apply([(student, target), (other, current)]) for delta, other in sorted(swaps)):
+					break
@@ -10,6 +10,12 @@ import pprint
 import random
 import sys
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from common import derive_seed, in_order, iteration_ranges, map_chunks, SearchBudget
 from session import Session
 from student import Student
 
@@ -57,59 +63,256 @@ def define_students(filename):
 	return selections
 
 
-def match(sessions, selections):
+def match(sessions, selections, rng=random):
 	"""
 	Algorithm: place students in reverse grade order: shuffle students, then place as many first choices as possible,
 			   then repeat for 2nd, 3rd, 4th, and 5th choices.
 			   Modifies sessions dictionary parameter in-place.
 	:param sessions:
 	:param selections:
+	:param rng: random number generator used to shuffle each grade
 	:return: a list of unplaced student identifiers
 	"""
-	unplaced = []
-	grades = sorted(selections.keys(), key=lambda grade: -grade)
-	for grade in grades:
-		random.shuffle(selections[grade])
-		for student in selections[grade]:
+	names, rows = choice_rows(sessions, selections)
+	left = [sessions[name].left for name in names]
+	return place(sessions, selections, names, assign(left, rows, rng))
+
+
+def choice_rows(sessions, selections):
+	"""
+	Interns session names so that a matching can run on session indices and space counters only
+	:param sessions: dictionary of Session objects
+	:param selections: dictionary of Student objects keyed by grade level
+	:return: (session names, {grade: rows}), where each row lists a student's choices as session indices,
+			 rows follow selections[grade], and unknown sessions are -1
+	"""
+	names = sorted(sessions.keys())
+	index = dict((name, i) for i, name in enumerate(names))
+	rows = {}
+	for grade in selections:
+		rows[grade] = [[index.get(choice, -1) for choice in student.choices] for student in selections[grade]]
+	return names, rows
+
+
+def assign(left, rows, rng=random):
+	"""
+	The matching of match, on lightweight state: remaining space per session plus an assignment per student
+	:param left: remaining space per session index; decremented in place
+	:param rows: {grade: rows} from choice_rows
+	:param rng: random number generator used to shuffle each grade
+	:return: (grade, shuffled, held, preference) per grade, in placement order, where the i-th student in shuffle
+			 order is rows[grade][shuffled[i]] and was placed in session held[i] as choice preference[i];
+			 held[i] is -1 if unplaced
+	"""
+	assigned = []
+	for grade in sorted(rows.keys(), key=lambda grade: -grade):
+		shuffled = list(range(len(rows[grade])))
+		rng.shuffle(shuffled)
+		held = []
+		preferences = []
+		for index in shuffled:
+			session = -1
 			preference = 0
-			placed = False
-			while preference < len(student.choices) and not placed:
-				try:
-					placed = sessions[student.get_choice(preference)].register(student, preference)
-				except KeyError:
-					pass
-				preference += 1
-			if not placed:
+			for preference, choice in enumerate(rows[grade][index]):
+				if choice >= 0 and left[choice] > 0:
+					left[choice] -= 1
+					session = choice
+					break
+			held.append(session)
+			preferences.append(preference)
+		assigned.append((grade, shuffled, held, preferences))
+	return assigned
+
+
+def place(sessions, selections, names, assigned):
+	"""
+	Materializes the result of assign or assign_vectorized into the Session rosters
+	:return: a list of unplaced student identifiers
+	"""
+	unplaced = []
+	for grade, shuffled, held, preferences in assigned:
+		for row, index in enumerate(shuffled):
+			student = selections[grade][index]
+			if held[row] >= 0:
+				sessions[names[held[row]]].add_student(student, preferences[row])
+			else:
 				unplaced.append(student.get_id())
 	return unplaced
 
 
-def match_n_times(sessions, students, iterations):
+def count_unplaced(assigned):
+	"""
+	:param assigned: result of assign or assign_vectorized
+	:return: number of unplaced students
+	"""
+	return sum(held.count(-1) for grade, shuffled, held, preferences in assigned)
+
+
+def choice_matrices(sessions, selections):
+	"""
+	choice_rows as numpy arrays, for assign_vectorized
+	:return: (session names, {grade: students x choices matrix}), padded with -1
+	"""
+	names, rows = choice_rows(sessions, selections)
+	matrices = {}
+	for grade in rows:
+		width = max([len(row) for row in rows[grade]] + [0])
+		matrices[grade] = numpy.array([row + [-1] * (width - len(row)) for row in rows[grade]],
+									  dtype=numpy.int32).reshape(len(rows[grade]), width)
+	return names, matrices
+
+
+def match_vectorized(sessions, selections, rng=random, matrices=None):
+	"""
+	Same placement as match, computed a whole round at a time with numpy.
+	Modifies sessions dictionary parameter in-place.
+	:param sessions: dictionary of Session objects
+	:param selections: dictionary of Student objects keyed by grade level
+	:param rng: random number generator used to shuffle each grade
+	:param matrices: choice_matrices(sessions, selections), if already computed
+	:return: a list of unplaced student identifiers
+	"""
+	names, matrices = matrices or choice_matrices(sessions, selections)
+	left = numpy.array([sessions[name].left for name in names], dtype=numpy.int64)
+	return place(sessions, selections, names, assign_vectorized(left, matrices, rng))
+
+
+def assign_vectorized(left, matrices, rng=random):
+	"""
+	Same result as assign, computed a whole round at a time with numpy.
+	Placing a shuffled grade one student at a time is deferred acceptance in which every session prefers
+	students earlier in the shuffle, so each grade is run as rounds of deferred acceptance instead: all free
+	students apply to their next choice at once, and every session keeps the earliest-shuffled applicants up
+	to its remaining capacity. Consumes RNG exactly as assign does, so the same RNG state gives the same result.
+	:param left: numpy array of remaining space per session index; decremented in place
+	:param matrices: {grade: matrix} from choice_matrices
+	:param rng: random number generator used to shuffle each grade
+	:return: same as assign
+	"""
+	assigned = []
+	for grade in sorted(matrices.keys(), key=lambda grade: -grade):
+		shuffled = list(range(len(matrices[grade])))
+		rng.shuffle(shuffled)
+		# row i is the i-th student in shuffle order, so a lower row wins every tie
+		choices = matrices[grade][shuffled]
+		num_students, width = choices.shape
+		held = numpy.full(num_students, -1, dtype=numpy.int64)
+		next_choice = numpy.zeros(num_students, dtype=numpy.int64)
+		free = numpy.arange(num_students)
+		while free.size:
+			free = free[next_choice[free] < width]
+			proposed = choices[free, next_choice[free]]
+			next_choice[free] += 1
+			applicants = free[proposed >= 0]
+			targets = proposed[proposed >= 0]
+			free = free[proposed < 0]
+			if not applicants.size:
+				continue
+			# each session applied to re-ranks its held students together with its new applicants
+			holders = numpy.flatnonzero(numpy.isin(held, targets))
+			candidates = numpy.concatenate((holders, applicants))
+			candidate_sessions = numpy.concatenate((held[holders], targets))
+			ranked = numpy.lexsort((candidates, candidate_sessions))
+			candidates = candidates[ranked]
+			candidate_sessions = candidate_sessions[ranked]
+			starts = numpy.flatnonzero(numpy.r_[True, candidate_sessions[1:] != candidate_sessions[:-1]])
+			sizes = numpy.diff(numpy.r_[starts, candidates.size])
+			position = numpy.arange(candidates.size) - numpy.repeat(starts, sizes)
+			accepted = position < left[candidate_sessions]
+			held[candidates[accepted]] = candidate_sessions[accepted]
+			held[candidates[~accepted]] = -1
+			free = numpy.concatenate((free, candidates[~accepted]))
+		left -= numpy.bincount(held[held >= 0], minlength=left.size)
+		assigned.append((grade, shuffled, held.tolist(), (next_choice - 1).tolist()))
+	return assigned
+
+
+def match_n_times(sessions, students, iterations, seed=None, workers=1, time_limit=None, patience=None):
 	"""
-	Runs match function <iterations> times, with random shuffle of student keys each iteration
+	Runs match function up to <iterations> times, with random shuffle of student keys each iteration, stopping
+	as soon as every student is placed.
+	Iterations only keep space counters and assignment lists; the best one is replayed from its seed
+	into a copy of SESSIONS at the end.
 	:param sessions: dictionary of Session objects
 	:param students: dictionry of Student objects keyed by grade level
-	:param iterations: number of times to run the algorithm
-	:return:
+	:param iterations: number of times to run the algorithm; None for no limit other than TIME_LIMIT and PATIENCE
+	:param seed: seed of the search; the same seed gives the same result for any number of workers
+	:param workers: number of processes to spread the iterations over
+	:param time_limit: seconds after which no new iteration is started
+	:param patience: stop after PATIENCE iterations in a row without fewer unplaced students
+	:return: number of iterations run, the best matching, its unplaced students and its seed
 	"""
-	best_match = {}
-	best_unplaced = []
-	fewest_unmatched = float('Inf')
-	iteration = -1
-	for i in range(0, iterations):
-		iteration = i
-		if iterations == 1:
-			copy_classes = sessions
+	if seed is None:
+		seed = random.randrange(2 ** 32)
+	budget = SearchBudget(time_limit, patience, 0)
+	chunks = ((seed, start, stop, budget) for start, stop in iteration_ranges(iterations, workers))
+	results = map_chunks(_match_chunk, chunks, workers, _init_worker, (sessions, students))
+	for start, stop, stopped, records in in_order(results):
+		if budget.take(records, stopped, stop):
+			break
+	results.close()
+	fewest_unmatched, best_iteration = budget.best
+	best_match = copy.deepcopy(sessions)
+	best_seed = derive_seed(seed, best_iteration)
+	best_unplaced = replay(best_match, students, best_seed)
+	return budget.iterations, best_match, best_unplaced, best_seed
+
+
+def replay(sessions, students, seed):
+	"""
+	Performs the single matching of a seed reported by match_n_times
+	:param sessions: dictionary of Session objects, modified in-place
+	:param students: dictionry of Student objects keyed by grade level
+	:param seed: seed of the iteration, as returned by match_n_times
+	:return: a list of unplaced student identifiers
+	"""
+	rng = random.Random(seed)
+	if numpy is not None:
+		return match_vectorized(sessions, students, rng)
+	return match(sessions, students, rng)
+
+
+# state of a match_n_times worker process, set once by _init_worker
+_worker_space = None
+_worker_rows = None
+
+
+def _init_worker(sessions, students):
+	global _worker_space, _worker_rows
+	if numpy is not None:
+		names, _worker_rows = choice_matrices(sessions, students)
+		_worker_space = numpy.array([sessions[name].left for name in names], dtype=numpy.int64)
+	else:
+		names, _worker_rows = choice_rows(sessions, students)
+		_worker_space = [sessions[name].left for name in names]
+
+
+def _match_chunk(chunk):
+	"""
+	Runs iterations START to STOP of a match_n_times search, stopping early if every student is placed
+	:return: START, STOP, iteration after the last one run, and (number unplaced, iteration) of every iteration
+			 that placed more students than the earlier ones
+	"""
+	seed, start, stop, budget = chunk
+	best = None
+	records = []
+	left = copy.copy(_worker_space)
+	for iteration in range(start, stop):
+		if iteration > 0 and budget.expired():
+			return start, stop, iteration, records
+		left[:] = _worker_space
+		rng = random.Random(derive_seed(seed, iteration))
+		if numpy is not None:
+			unplaced = count_unplaced(assign_vectorized(left, _worker_rows, rng))
 		else:
-			copy_classes = copy.deepcopy(sessions)
-		res = match(copy_classes, students)
-		if len(res) < fewest_unmatched:
-			fewest_unmatched = len(res)
-			best_unplaced = res
-			best_match = copy_classes
-			if len(res) == 0:
-				break
-	return iteration+1, best_match, best_unplaced
+			unplaced = count_unplaced(assign(left, _worker_rows, rng))
+		if best is None or unplaced < best:
+			best = unplaced
+			records.append((unplaced, iteration))
+			if budget.reached(unplaced):
+				return start, stop, iteration + 1, records
+	return start, stop, stop, records
+
 
 def write_results_to_file(sessions, file):
 	"""Writes the result dictionary to a file in csv format.
@@ -159,7 +362,13 @@ def main():
 	"""
 	parser = argparse.ArgumentParser(description="Sort n students into m sessions with x slots per class and 3 ordered selections per student. Heuristic purely weights fewest unplaced students (according to their selections) as best.")
 	parser.add_argument("-v", "--verbose", help="output placement round session statistics and unplaced student SIDs to console", action="store_true")
-	parser.add_argument("--iterate", help="perform i matchings and keep the best run (default is 1)", type=int, default=1)
+	parser.add_argument("--iterate", help="perform up to i matchings and keep the best run (default is 1, or no limit with --time-limit or --patience)", type=int)
+	parser.add_argument("--time-limit", help="start no new matching after TIME_LIMIT seconds", type=float)
+	parser.add_argument("--patience", help="stop after PATIENCE matchings in a row without fewer unplaced students", type=int)
+	parser.add_argument("--workers", help="spread the iterations over WORKERS processes (default is 1)", type=int, default=1)
+	seeding = parser.add_mutually_exclusive_group()
+	seeding.add_argument("--seed", help="seed of the random shuffles; the same seed gives the same result for any number of workers", type=int)
+	seeding.add_argument("--replay", help="perform only the matching of winning seed REPLAY, as printed by an earlier run", type=int)
 	parser.add_argument("classes_csv", help="name of the class data csv file to use (relative path)")
 	parser.add_argument("students_csv", help="name of the student data csv file to use (relative path)")
 	parser.add_argument("output_csv", help="name of the (new) csv file to write to (relative path)")
@@ -171,9 +380,19 @@ def main():
 	total_space = sum([sessions[session].get_space() for session in sessions])
 	num_students = sum([len(students[grade]) for grade in students])
 	if total_space < num_students:
-		print("not enough space for all students! Attempting to place " + num_students + " students in " + total_space + " spaces.")
+		print("not enough space for all students! Attempting to place " + str(num_students) + " students in " + str(total_space) + " spaces.")
 	else:
-		iterations, best_matching, fewest_unmatched = match_n_times(sessions, students, args.iterate)
+		if args.replay is not None:
+			iterations, best_matching, best_seed = 1, sessions, args.replay
+			fewest_unmatched = replay(best_matching, students, best_seed)
+		else:
+			iterations = args.iterate
+			if iterations is None and args.time_limit is None and args.patience is None:
+				iterations = 1
+			iterations, best_matching, fewest_unmatched, best_seed = match_n_times(sessions, students, iterations,
+																				   args.seed, args.workers,
+																				   args.time_limit, args.patience)
+		print("Winning seed: " + str(best_seed) + " (rerun this matching alone with --replay " + str(best_seed) + ")")
 		write_results_to_file(best_matching, args.output_csv)
 		if args.verbose:
 			stats(iterations, best_matching, fewest_unmatched)
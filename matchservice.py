@@ -0,0 +1,453 @@
+#!/usr/bin/python
+
+"""Matching service: keeps the parsed input in memory and matches on request, over a local JSON socket API
+
+Requests and responses are single lines of JSON, over a Unix socket (--socket) or a TCP port on localhost (--port).
+Every request has an "op"; a request with an "id" gets it back in its response. Failed requests get an "error".
+
+	{"op": "info"}
+		version, number of students and sessions of the input held in memory
+	{"op": "load"}
+		parses the input files again
+	{"op": "edit", "edits": [["cap", CLASSNAME, NUM_SPACES], ["student", SID, GRADE_LEVEL, CHOICE_1, ...],
+							  ["drop", SID], ...]}
+		applies edits, as in the delta files of rematch.py, to the input held in memory
+	{"op": "match", "iterate": N, "seed": S, "replay": S, "presort": N, "time_limit": SECONDS, "patience": N,
+	 "bound": "capacity" or "flow", "decompose": true, "improve": true, "stats": true,
+	 "output": FILENAME, "format": "csv", "gzip" or "packed"}
+		performs a search as smartmatch.py does, with every option optional. The response holds the result,
+		bound, iterations and seeds, and either the number of rows written to OUTPUT or the assignment as
+		[SID, CLASSNAME] pairs; with "stats", also the figures of SmartMatch.stats. OUTPUT is a relative path
+		within the directory given by --output-dir, and is only accepted if the service was started with one.
+
+Requests from different connections are handled concurrently: matches run in a pool of worker processes, each on
+the input as it was when the match was requested, while edits build a new copy of the input.
+"""
+
+# native imports
+import argparse
+import asyncio
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import compress
+import json
+import os
+import random
+import signal
+import socket
+import stat
+
+# local imports
+from bulkloader import LoadReport, choice_name, load_arrays
+from components import find_components
+from indexedmatch import IndexedMatch, MatchArrays, choice_array
+from resultwriter import UNASSIGNED
+from smartmatch import SmartInput, capacity_bound, flow_bound, search, search_components
+from common import derive_seed, SearchBudget
+
+# longest request line accepted, in bytes
+LINE_LIMIT = 1 << 26
+MATCH_OPTIONS = set(["iterate", "seed", "replay", "presort", "time_limit", "patience", "bound", "decompose",
+					 "improve", "stats", "output", "format"])
+
+
+def apply_edits(arrays, edits, integer_class_names, unknown_cells=None):
+	"""
+	Applies edits to a copy of the input; ARRAYS itself is left as it is, for matches still running on it
+	:param arrays: MatchArrays of the input
+	:param edits: list of edits, as rows of a rematch.py delta file:
+				  cap, CLASSNAME, NUM_SPACES
+				  student, SID, GRADE_LEVEL, CHOICE_1, CHOICE_2, CHOICE_3, CHOICE_4, CHOICE_5
+				  drop, SID
+	:param integer_class_names: classes are integer numbered instead of named
+	:param unknown_cells: SID -> tuple of (choice position, session name) of the choices of sessions ARRAYS does
+						  not hold, as in LoadReport.unknown_cells; they are chosen again once a cap edit opens them
+	:return: MatchArrays of the edited input, the number of edits skipped because they do not parse, and the
+			 unknown_cells of the edited input
+	"""
+	unknown_cells = dict(unknown_cells or {})
+	spaces = dict(zip(arrays.session_names, arrays.capacity))
+	# SID -> (grade, choice names) of new or replaced students, or None for dropped ones
+	changed = {}
+	skipped = 0
+	for row in edits:
+		try:
+			edit = str(row[0]).strip().lower()
+			if edit == "cap":
+				spaces[str(row[1]).strip().lower()] = int(row[2])
+			elif edit == "student":
+				grade = int(row[2])
+				if not -2 ** 15 <= grade < 2 ** 15:  # grades are kept as 16-bit integers
+					raise ValueError("grade out of range")
+				changed[str(row[1])] = (grade, [choice_name(str(cell), integer_class_names) for cell in row[3:]])
+			elif edit == "drop":
+				changed[str(row[1])] = None
+			else:
+				skipped += 1
+		except (IndexError, ValueError, TypeError):
+			skipped += 1
+
+	session_names = sorted(name for name in spaces if spaces[name] > 0)
+	session_index = dict((name, index) for index, name in enumerate(session_names))
+	choices = arrays.choices
+	if session_names != arrays.session_names:
+		# old session index -> new one; the trailing -1 is what -1 (unknown, padding) reads
+		renumber = [session_index.get(name, -1) for name in arrays.session_names] + [-1]
+		choices = choice_array(len(session_names))
+		choices.extend(map(renumber.__getitem__, arrays.choices))
+		# choices of the sessions closed keep their names, for when they open again
+		closed = bytearray([name not in session_index for name in arrays.session_names]) + b"\0"
+		for cell in compress(range(len(arrays.choices)), map(closed.__getitem__, arrays.choices)):
+			student, pref = divmod(cell, arrays.width)
+			sid = arrays.sids[student]
+			unknown_cells[sid] = unknown_cells.get(sid, ()) + ((pref, arrays.session_names[arrays.choices[cell]]),)
+		# choices of the sessions opened reach the students who already chose them
+		for sid, cells in list(unknown_cells.items()):
+			if any(name in session_index for pref, name in cells):
+				student = bisect_left(arrays.sids, sid)
+				for pref, name in cells:
+					if name in session_index:
+						choices[student * arrays.width + pref] = session_index[name]
+				unknown_cells[sid] = tuple(cell for cell in cells if cell[1] not in session_index)
+				if not unknown_cells[sid]:
+					del unknown_cells[sid]
+	capacity = array('i', [spaces[name] for name in session_names])
+	if not changed:
+		return MatchArrays(session_names, capacity, arrays.sids, arrays.grades, arrays.num_choices, arrays.width,
+						   choices), skipped, unknown_cells
+	for sid, value in changed.items():
+		unknown_cells.pop(sid, None)
+		if value is not None:
+			cells = tuple((pref, name) for pref, name in enumerate(value[1]) if name not in session_index)
+			if cells:
+				unknown_cells[sid] = cells
+
+	added = sorted((sid, value[0], [session_index.get(name, -1) for name in value[1]])
+				   for sid, value in changed.items() if value is not None)
+	width = max([arrays.width] + [len(row) for sid, grade, row in added])
+	if width > arrays.width:
+		# pad every row out to the new width
+		padded = choice_array(len(session_names))
+		padding = [-1] * (width - arrays.width)
+		for student in range(arrays.get_num_students()):
+			padded.extend(choices[student * arrays.width:(student + 1) * arrays.width])
+			padded.extend(padding)
+		choices = padded
+	# students are kept in canonical (SID) order: the unchanged ones are copied over in runs between the
+	# positions of dropped, replaced and new students
+	dropped = set([])
+	inserted = {}
+	for sid in changed:
+		position = bisect_left(arrays.sids, sid)
+		if position < len(arrays.sids) and arrays.sids[position] == sid:
+			dropped.add(position)
+	for entry in added:
+		inserted.setdefault(bisect_left(arrays.sids, entry[0]), []).append(entry)
+	sids = []
+	grades = array('h')
+	num_choices = array('b')
+	edited_choices = choice_array(len(session_names))
+	start = 0
+	for position in sorted(dropped | set(inserted) | set([arrays.get_num_students()])):
+		sids.extend(arrays.sids[start:position])
+		grades.extend(arrays.grades[start:position])
+		num_choices.extend(arrays.num_choices[start:position])
+		edited_choices.extend(choices[start * width:position * width])
+		for sid, grade, row in inserted.get(position, ()):
+			sids.append(sid)
+			grades.append(grade)
+			num_choices.append(len(row))
+			edited_choices.extend(row + [-1] * (width - len(row)))
+		start = position + 1 if position in dropped else position
+	return (MatchArrays(session_names, capacity, sids, grades, num_choices, width, edited_choices), skipped,
+			unknown_cells)
+
+
+def edited_report(report, unknown_cells):
+	"""
+	:param report: LoadReport of the input files
+	:param unknown_cells: unknown_cells of the input after edits, from apply_edits
+	:return: LoadReport with the malformed rows of REPORT, which edits do not change, and the choices of sessions
+			 missing after the edits
+	"""
+	edited = LoadReport()
+	edited.malformed = report.malformed
+	edited.unknown_cells = unknown_cells
+	for cells in unknown_cells.values():
+		edited.unknown_choices += len(cells)
+		edited.unknown_sessions.update(name for pref, name in cells)
+	return edited
+
+
+def output_path(directory, filename):
+	"""
+	:param directory: directory results may be written to, or None if they may not be written
+	:param filename: relative path of the results file within DIRECTORY, as requested
+	:return: the path of the results file
+	:raise ValueError: if no DIRECTORY is given, or FILENAME is absolute or leads out of it
+	"""
+	if directory is None:
+		raise ValueError("output is only written if the service is started with --output-dir")
+	filename = str(filename)
+	if not filename or os.path.isabs(filename) or os.pardir in filename.replace(os.sep, "/").split("/"):
+		raise ValueError("output must be a relative path within the output directory, without " + os.pardir)
+	path = os.path.join(directory, filename)
+	# symbolic links out of the directory are not followed
+	if os.path.commonpath([os.path.realpath(directory), os.path.realpath(path)]) != os.path.realpath(directory):
+		raise ValueError("output must be a relative path within the output directory")
+	return path
+
+
+def _run_match(smart_input, options):
+	"""
+	Performs the search of a match request in a worker process, as smartmatch.py does
+	:param smart_input: SmartInput of the input as it was when the match was requested
+	:param options: the options of the request
+	:return: json-serializable response
+	"""
+	response = {}
+	presort = options.get("presort")
+	if options.get("replay") is not None:
+		seed = options["replay"]
+		result, assignment = smart_input.run(seed, presort)
+		response.update({"result": result, "winning_seed": seed})
+	else:
+		seed = options.get("seed")
+		if seed is None:
+			seed = random.randrange(2 ** 32)
+		iterations = options.get("iterate")
+		time_limit = options.get("time_limit")
+		patience = options.get("patience")
+		if iterations is None and time_limit is None and patience is None:
+			iterations = 1
+		bound_kind = options.get("bound", "capacity")
+		components = find_components(smart_input.arrays) if options.get("decompose") else []
+		if smart_input.engine.single_pass and (options.get("iterate") is not None or time_limit is not None or
+											   patience is not None):
+			raise ValueError(smart_input.engine.__name__ + " finds its matching in one pass, whatever the seed; " +
+							 "iterate, time_limit and patience do not apply")
+		if len(components) > 1:
+			result, bound, num_iterations, assignment = search_components(
+				smart_input, components, iterations, seed, presort, 1, None, None, time_limit, patience, bound_kind)
+			winning_seed = None
+		elif smart_input.engine.single_pass:
+			result, assignment = smart_input.run(seed, presort)
+			bound = result
+			num_iterations = 1
+			winning_seed = seed
+		else:
+			bound = flow_bound(smart_input) if bound_kind == "flow" else capacity_bound(smart_input.arrays)
+			budget = SearchBudget(time_limit, patience, bound)
+			result, iteration, assignment = search(smart_input, iterations, seed, presort, 1, None, None, budget)
+			num_iterations = budget.iterations
+			winning_seed = derive_seed(seed, iteration)
+		response.update({"result": result, "bound": bound, "iterations": num_iterations, "seed": seed,
+						 "winning_seed": winning_seed})
+	if options.get("improve"):
+		result, assignment = smart_input.improve(assignment)
+		response["improved_result"] = result
+	if options.get("output"):
+		response["written"] = smart_input.write(options["output"], assignment, options.get("format"))
+	else:
+		labels = smart_input.session_names + [UNASSIGNED]
+		response["assignment"] = list(zip(smart_input.arrays.sids, [labels[index] for index, choice in assignment]))
+	if options.get("stats"):
+		response["stats"] = smart_input.decode(assignment).summary()
+	return response
+
+
+class MatchService:
+	def __init__(self, classes_csv, students_csv, integer_class_names, engine=IndexedMatch, workers=1,
+				 output_dir=None):
+		"""
+		Input files parsed once and kept in memory, with a pool of processes to match in
+		:param classes_csv: class data in csv format, one class per line:
+							CLASSNAME, NUM_SPACES
+		:param students_csv: student data in csv format, one student per line:
+							 SID, GRADE_LEVEL, CHOICE_1, CHOICE_2, CHOICE_3, CHOICE_4, CHOICE_5
+		:param integer_class_names: classes are integer numbered instead of named
+		:param engine: IndexedMatch or a subclass of it, or a SmartMatch class, used to perform each matching
+		:param workers: number of matches performed at once
+		:param output_dir: directory match requests may write their results to; None to only return them
+		"""
+		self.classes_csv = classes_csv
+		self.students_csv = students_csv
+		self.class_numbers = integer_class_names
+		self.engine = engine
+		self.workers = workers
+		self.output_dir = output_dir
+		self.executor = ProcessPoolExecutor(workers)
+		# SmartInput of the current input, replaced as a whole by every load and edit, and the LoadReport of its
+		# problems, whose unknown_cells hold the names of the choices of sessions it does not hold
+		self.smart_input = None
+		self.version = 0
+		self.report = None
+		self.edit_lock = None
+		self.load()
+
+	def load(self):
+		arrays, report = load_arrays(self.classes_csv, self.students_csv, self.class_numbers)
+		self.report = report
+		self._replace(arrays)
+
+	def _replace(self, arrays):
+		self.smart_input = SmartInput(None, None, self.class_numbers, self.engine, arrays)
+		self.version += 1
+
+	def info(self):
+		arrays = self.smart_input.arrays
+		return {"version": self.version, "students": arrays.get_num_students(), "sessions": arrays.get_num_sessions(),
+				"problems": str(self.report) if self.report.has_problems() else None}
+
+	async def handle(self, message):
+		"""
+		:param message: decoded request
+		:return: json-serializable response
+		"""
+		loop = asyncio.get_running_loop()
+		op = message.get("op")
+		if op == "info":
+			return self.info()
+		if op == "load":
+			async with self.edit_lock:
+				await loop.run_in_executor(None, self.load)
+			return self.info()
+		if op == "edit":
+			async with self.edit_lock:
+				arrays, skipped, unknown_cells = await loop.run_in_executor(
+					None, apply_edits, self.smart_input.arrays, message["edits"], self.class_numbers,
+					self.report.unknown_cells)
+				self.report = edited_report(self.report, unknown_cells)
+				self._replace(arrays)
+			response = self.info()
+			response["skipped"] = skipped
+			return response
+		if op == "match":
+			unknown = set(message) - MATCH_OPTIONS - set(["op", "id"])
+			if unknown:
+				raise ValueError("unknown match option(s): " + ", ".join(sorted(unknown)))
+			if message.get("output"):
+				message = dict(message, output=output_path(self.output_dir, message["output"]))
+			version = self.version
+			try:
+				response = await loop.run_in_executor(self.executor, _run_match, self.smart_input, message)
+			except BrokenProcessPool:
+				# a worker died: later matches get a new pool
+				self.executor.shutdown(wait=False)
+				self.executor = ProcessPoolExecutor(self.workers)
+				raise
+			response["version"] = version
+			return response
+		raise ValueError("unknown op: " + str(op))
+
+	async def serve_client(self, reader, writer):
+		"""
+		Answers the requests of one connection, in order
+		"""
+		try:
+			while True:
+				line = await reader.readline()
+				if not line:
+					break
+				message = {}
+				try:
+					message = json.loads(line)
+					response = await self.handle(message)
+				except (AttributeError, KeyError, ValueError, TypeError, OverflowError, OSError, BrokenProcessPool,
+						RuntimeError) as error:
+					response = {"error": type(error).__name__ + ": " + str(error)}
+				if isinstance(message, dict) and "id" in message:
+					response["id"] = message["id"]
+				writer.write(json.dumps(response).encode("utf-8") + b"\n")
+				await writer.drain()
+		finally:
+			writer.close()
+
+	async def serve(self, socket_path=None, port=None):
+		"""
+		Serves requests on SOCKET_PATH, or on PORT of localhost, until cancelled
+		"""
+		self.edit_lock = asyncio.Lock()
+		if socket_path is not None:
+			_remove_socket(socket_path)
+			server = await asyncio.start_unix_server(self.serve_client, socket_path, limit=LINE_LIMIT)
+		else:
+			server = await asyncio.start_server(self.serve_client, "127.0.0.1", port, limit=LINE_LIMIT)
+		try:
+			asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+		except NotImplementedError:
+			pass
+		try:
+			async with server:
+				await server.serve_forever()
+		finally:
+			if socket_path is not None:
+				_remove_socket(socket_path)
+			self.executor.shutdown(cancel_futures=True)
+
+
+def _remove_socket(socket_path):
+	# a socket left behind by an earlier service; anything else at that path is left alone
+	if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+		os.remove(socket_path)
+
+
+def request(message, socket_path=None, port=None):
+	"""
+	Sends one request to a running service and waits for its response
+	:param message: request, as a dictionary
+	:param socket_path: Unix socket the service listens on
+	:param port: TCP port of localhost the service listens on, if not SOCKET_PATH
+	:return: the decoded response
+	"""
+	if socket_path is not None:
+		connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		connection.connect(socket_path)
+	else:
+		connection = socket.create_connection(("127.0.0.1", port))
+	with connection, connection.makefile('rwb') as stream:
+		stream.write(json.dumps(message).encode("utf-8") + b"\n")
+		stream.flush()
+		return json.loads(stream.readline())
+
+
+def main():
+	parser = argparse.ArgumentParser(
+		description="Keep the class and student data in memory and match on request, over a local JSON socket API.")
+	parser.add_argument("-n", "--numeric",
+						help="classes are integer numbered instead of named", action="store_true")
+	parser.add_argument("--engine", help="smart: randomized deferred acceptance (default); rounds: the same, " +
+						"with all free students proposing at once in every round; flow: optimal assignment in one " +
+						"pass via min-cost flow", choices=["smart", "rounds", "flow"], default="smart")
+	parser.add_argument("--workers", help="number of matches performed at once (default is 1)", type=int, default=1)
+	parser.add_argument("--output-dir", help="directory match requests may write their results to, by a relative " +
+						"path; without it, results are only returned")
+	address = parser.add_mutually_exclusive_group(required=True)
+	address.add_argument("--socket", help="listen on Unix socket SOCKET")
+	address.add_argument("--port", help="listen on TCP port PORT of localhost", type=int)
+	parser.add_argument("classes_csv", help="name of the class data csv file to use (relative path)")
+	parser.add_argument("students_csv", help="name of the student data csv file to use (relative path)")
+	args = parser.parse_args()
+
+	engine = IndexedMatch
+	if args.engine == "flow":
+		from flowmatch import FlowMatch
+		engine = FlowMatch
+	elif args.engine == "rounds":
+		from roundmatch import RoundMatch
+		engine = RoundMatch
+	service = MatchService(args.classes_csv, args.students_csv, args.numeric, engine, args.workers, args.output_dir)
+	if service.report.has_problems():
+		print(service.report)
+	print("Serving " + str(service.info()["students"]) + " students on " +
+		  (args.socket if args.socket is not None else "127.0.0.1:" + str(args.port)))
+	try:
+		asyncio.run(service.serve(args.socket, args.port))
+	except (KeyboardInterrupt, asyncio.CancelledError):
+		pass
+
+
+if __name__ == "__main__":
+	main()
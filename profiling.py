@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+# native imports
+import contextlib
+import json
+import time
+
+
+class MatchProfile:
+	# counters kept in total and per session
+	COUNTERS = ("proposals", "rejections", "displacements", "unknown_sessions", "heap_operations")
+
+	def __init__(self):
+		"""
+		Counts matching events and times the phases of a run. Engines only touch a profile when one is given,
+		so runs without --profile pay nothing but a None check per event.
+		"""
+		self.phases = {}
+		self.counters = dict.fromkeys(self.COUNTERS, 0)
+		self.sessions = {}
+		self.iterations = 0
+		# seed of the winning iteration, if known
+		self.seed = None
+
+	def count(self, counter, session=None, amount=1):
+		"""
+		:param counter: one of COUNTERS
+		:param session: name of the session the event happened in, if any
+		:param amount: number of events
+		"""
+		self.counters[counter] += amount
+		if session is not None:
+			if session not in self.sessions:
+				self.sessions[session] = dict.fromkeys(self.COUNTERS, 0)
+			self.sessions[session][counter] += amount
+
+	def add_time(self, name, seconds):
+		self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+	def merge(self, other):
+		"""
+		Adds the counts and times of another profile, e.g. one collected in a worker process
+		:param other: MatchProfile.to_dict() of the other profile
+		"""
+		for name in other["phases"]:
+			self.add_time(name, other["phases"][name])
+		for counter in other["counters"]:
+			self.counters[counter] += other["counters"][counter]
+		for session in other["sessions"]:
+			if session not in self.sessions:
+				self.sessions[session] = dict.fromkeys(self.COUNTERS, 0)
+			for counter in other["sessions"][session]:
+				self.sessions[session][counter] += other["sessions"][session][counter]
+		self.iterations += other["iterations"]
+
+	def to_dict(self):
+		"""
+		:return: the profile as a json-serializable dictionary; sessions are listed by number of displacements,
+				 which is where eviction cascades start
+		"""
+		cascades = sorted(self.sessions.keys(), key=lambda session: (-self.sessions[session]["displacements"], session))
+		return {
+			"phases": self.phases,
+			"iterations": self.iterations,
+			"seed": self.seed,
+			"counters": self.counters,
+			"sessions": self.sessions,
+			"most_displacements": cascades[:10],
+		}
+
+	def write(self, filename):
+		with open(filename, 'w') as write_file:
+			json.dump(self.to_dict(), write_file, indent=2, sort_keys=True)
+
+
+@contextlib.contextmanager
+def phase(profile, name):
+	"""
+	Times the enclosed block as phase NAME of PROFILE; does nothing if PROFILE is None
+	"""
+	if profile is None:
+		yield
+		return
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		profile.add_time(name, time.perf_counter() - start)
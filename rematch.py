@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+"""Re-matching after late edits: starts from a previous output and only moves the students a delta affects"""
+
+# native imports
+import argparse
+import csv
+import heapq
+from itertools import count
+import random
+
+# local imports
+from resultwriter import read_assignment
+from smartmatch import SmartMatch, define_sessions, define_students
+from smartsession import SmartSession
+from smartstudent import SmartStudent
+
+
+class ReMatch(SmartMatch):
+	def __init__(self, students, sessions, integer_class_names):
+		"""
+		:param students: collection of SmartStudent objects from define_students
+		:param sessions: dictionary of SmartSession objects from define_sessions
+		:param integer_class_names: classes are integer numbered instead of named
+		"""
+		super(ReMatch, self).__init__([], sessions, integer_class_names)
+		self.by_id = dict((student.get_id(), student) for student in students)
+		# names of sessions that may have a seat open for a student who ranked them higher
+		self.vacancies = []
+		# session name -> students who chose it, indexed once on the first vacancy
+		self.chosen_by = None
+		# session name -> heap of (-grade, order, student) of the students who chose it, highest grade first, built
+		# on the first vacancy of the session; entries of students who no longer rank it above their placement are
+		# dropped when they reach the top
+		self.rankers = {}
+		self.order = count()
+
+	def load_results(self, filename):
+		"""
+		Restores a previous matching from a file written by results_to_file.
+		Students missing from the file, or placed in a session they did not choose, start out unplaced.
+		:param filename: previous output file (csv, gzip or packed), one student per line:
+						 SID, CLASSNAME (or UNASSIGNED)
+		"""
+		loaded = set([])
+		for sid, name in read_assignment(filename):
+			if sid not in self.by_id:
+				continue
+			student = self.by_id[sid]
+			name = name.strip().lower()
+			choice = student.get_choice_index(name)
+			if name in self.sessions and choice >= 0:
+				student.current_choice = choice
+				self.sessions[name].register(student)
+				loaded.add(student)
+			elif name == "unassigned":
+				student.current_choice = len(student.choices)
+				self.unassigned.add(student)
+				loaded.add(student)
+		for student in self.by_id.values():
+			if student not in loaded:
+				self.students.append(student)
+
+	def apply_delta(self, filename):
+		"""
+		Applies late edits to the loaded matching. Rows that do not parse are skipped.
+		:param filename: delta csv file, one edit per line:
+						 cap, CLASSNAME, NUM_SPACES
+						 student, SID, GRADE_LEVEL, CHOICE_1, CHOICE_2, CHOICE_3, CHOICE_4, CHOICE_5
+						 drop, SID
+		"""
+		with open(filename, 'r') as input_file:
+			reader = csv.reader(input_file)
+			for row in reader:
+				if not row:
+					continue
+				edit = row[0].strip().lower()
+				try:
+					if edit == "cap":
+						self.set_cap(row[1].strip().lower(), int(row[2]))
+					elif edit == "student":
+						choices = row[3:]
+						if self.class_numbers:
+							choices = [str(int(x)) for x in choices]
+						self.set_student(SmartStudent(row[1], int(row[2]), choices))
+					elif edit == "drop":
+						self.drop_student(row[1])
+				except (IndexError, ValueError):
+					continue
+
+	def set_cap(self, name, space):
+		"""
+		Changes the number of spaces of a session, adding or removing it as needed;
+		the lowest-priority students of a session that shrinks move on to their next choice
+		"""
+		if name not in self.sessions:
+			if space <= 0:
+				return
+			self.sessions[name] = SmartSession(name, space)
+		session = self.sessions[name]
+		session.set_space(max(0, space))
+		while session.get_total_students() > session.get_space():
+			self.students.append(session.pop())
+		if space <= 0:
+			del self.sessions[name]
+		else:
+			self._check_space(name)
+
+	def set_student(self, smart_student):
+		"""
+		Adds a new student, or replaces the grade and choices of an existing one, who is then placed again
+		"""
+		if smart_student.get_id() in self.by_id:
+			self.drop_student(smart_student.get_id())
+		self.by_id[smart_student.get_id()] = smart_student
+		self.students.append(smart_student)
+
+	def drop_student(self, sid):
+		"""
+		Removes a student from the matching, opening up their seat
+		"""
+		student = self.by_id.pop(sid, None)
+		if student is None:
+			return
+		name = self._placement(student)
+		if name is not None:
+			self.sessions[name].remove(student)
+			self._check_space(name)
+		self.unassigned.discard(student)
+		if student in self.students:
+			self.students.remove(student)
+
+	def match(self):
+		"""
+		Deferred acceptance from the affected students only: unplaced students propose down their choices as in
+		SmartMatch.match, and every seat opened by the delta is offered to the highest-grade student who ranked
+		that session above their current placement, whose own seat is offered on in turn. Candidates are read off
+		the top of the session's heap of rankers, so the work follows the size of the delta, not of the input.
+		:return: sum of the grades of unassigned students
+		"""
+		while self.students or self.vacancies:
+			if self.students:
+				self._propose(self.students.pop())
+				continue
+			name = self.vacancies.pop()
+			session = self.sessions.get(name)
+			if session is None or not session.has_space():
+				continue
+			candidate = self._top_ranker(name)
+			if candidate is None:
+				continue
+			previous = self._placement(candidate)
+			if previous is None:
+				self.unassigned.discard(candidate)
+			else:
+				self.sessions[previous].remove(candidate)
+				self._check_space(previous)
+			candidate.current_choice = candidate.get_choice_index(name)
+			session.register(candidate)
+			self._check_space(name)
+		match_success = 0
+		for student in self.unassigned:
+			match_success += student.grade
+		return match_success
+
+	def _top_ranker(self, name):
+		"""
+		:return: the highest-grade student who ranked session NAME above their current placement, or None;
+				 the students above them in its heap are dropped from it
+		"""
+		if self.chosen_by is None:
+			self.chosen_by = {}
+			for student in self.by_id.values():
+				for chosen in set(student.choices):
+					self.chosen_by.setdefault(chosen, []).append(student)
+		if name not in self.rankers:
+			self.rankers[name] = [(-student.grade, next(self.order), student)
+								  for student in self.chosen_by.pop(name, [])]
+			heapq.heapify(self.rankers[name])
+		rankers = self.rankers[name]
+		while rankers:
+			student = rankers[0][2]
+			if self.by_id.get(student.get_id()) is student and \
+					student.get_choice_index(name) < student.get_current_choice():
+				return student
+			heapq.heappop(rankers)
+		return None
+
+	def _add_ranker(self, student):
+		"""
+		Puts STUDENT back among the rankers of their choices, once they are placed at a choice that may be worse
+		than before; entries of theirs already there are checked when they reach the top
+		"""
+		if self.chosen_by is None:
+			return
+		for name in set(student.choices):
+			if name in self.rankers:
+				heapq.heappush(self.rankers[name], (-student.grade, next(self.order), student))
+			else:
+				self.chosen_by.setdefault(name, []).append(student)
+
+	def _propose(self, student):
+		pref = student.get_current_choice()
+		if pref >= len(student.choices):
+			self.unassigned.add(student)
+			self._add_ranker(student)
+			return
+		session = self.sessions.get(student.get_choice(pref))
+		if session is None:
+			student.incr_current_choice()
+			self.students.append(student)
+		elif session.has_space():
+			session.register(student)
+			self._add_ranker(student)
+		elif session.outranks(student):
+			self.students.append(session.replace(student))
+			self._add_ranker(student)
+		else:
+			student.incr_current_choice()
+			self.students.append(student)
+
+	def _placement(self, student):
+		"""
+		:return: name of the session STUDENT is registered in, or None
+		"""
+		name = student.get_choice(student.get_current_choice())
+		if name in self.sessions and self.sessions[name].contains(student):
+			return name
+		return None
+
+	def _check_space(self, name):
+		if self.sessions[name].has_space():
+			self.vacancies.append(name)
+
+
+def main():
+	parser = argparse.ArgumentParser(
+		description="Re-match students after late edits, starting from a previous output file. Only students " +
+					"affected by the edits in the delta file are moved.")
+	parser.add_argument("-v", "--verbose",
+						help="output placement round session statistics and unplaced student SIDs to console",
+						action="store_true")
+	parser.add_argument("-n", "--numeric",
+						help="classes are integer numbered instead of named", action="store_true")
+	parser.add_argument("--seed", help="seed of the order affected students are placed in (default 0)", type=int,
+						default=0)
+	parser.add_argument("classes_csv", help="name of the class data csv file used for the previous run (relative path)")
+	parser.add_argument("students_csv", help="name of the student data csv file used for the previous run (relative path)")
+	parser.add_argument("previous_csv", help="name of the csv file written by the previous run (relative path)")
+	parser.add_argument("delta_csv", help="name of the csv file of edits to apply (relative path)")
+	parser.add_argument("output_csv", help="name of the (new) csv file to write to (relative path)")
+	args = parser.parse_args()
+
+	re_match = ReMatch(define_students(args.students_csv, args.numeric, random.Random(args.seed)),
+					   define_sessions(args.classes_csv), args.numeric)
+	re_match.load_results(args.previous_csv)
+	re_match.apply_delta(args.delta_csv)
+	re_match.match()
+	re_match.tallies = re_match.tally_choices()
+	re_match.results_to_file(args.output_csv)
+	if args.verbose:
+		re_match.stats()
+
+
+if __name__ == "__main__":
+	main()
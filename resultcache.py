@@ -0,0 +1,176 @@
+#!/usr/bin/python
+
+"""On-disk cache of search results, keyed by a hash of the parsed input, the engine, the seed and the presort"""
+
+# native imports
+from array import array
+import hashlib
+from itertools import chain
+import json
+import os
+import sys
+import tempfile
+import zlib
+
+# bumped whenever the key or the entry format changes, so older entries are never read
+VERSION = 2
+SUFFIX = ".result"
+DEFAULT_SIZE = 100 * 2 ** 20
+
+
+def search_key(arrays, engine, seed, presort=None):
+	"""
+	Hashes what the outcome of a search depends on, other than when it stops: the input as parsed into ARRAYS,
+	in canonical order, so that files differing only in row order, case or spacing share their results, and the
+	engine, seed and presort of the search
+	:param arrays: MatchArrays of the input
+	:param engine: class performing each matching
+	:return: hex digest
+	"""
+	digest = hashlib.sha256()
+	digest.update(json.dumps([VERSION, engine.__module__ + "." + engine.__name__, seed, presort]).encode("utf-8"))
+	digest.update(input_digest(arrays))
+	return digest.hexdigest()
+
+
+def input_digest(arrays):
+	"""
+	:return: sha256 digest of the input as parsed into ARRAYS
+	"""
+	digest = hashlib.sha256()
+	digest.update(json.dumps([arrays.width, arrays.session_names]).encode("utf-8"))
+	digest.update("\n".join(arrays.sids).encode("utf-8"))
+	for column in chain(arrays.block_capacity, [arrays.grades, arrays.num_choices, arrays.choices]):
+		digest.update(column.typecode.encode("ascii"))
+		digest.update(column.tobytes())
+	return digest.digest()
+
+
+def input_seed(arrays):
+	"""
+	:return: search seed below 2 ** 32 derived from the input, so that searches of the same input without a seed
+			 of their own are the same search, which the cache answers
+	"""
+	return int.from_bytes(input_digest(arrays)[:4], "little")
+
+
+class ResultCache:
+	def __init__(self, directory, max_size=DEFAULT_SIZE):
+		"""
+		Directory of searches, one file per key: a json line with the number of iterations taken, the records and
+		the best iteration, followed by the best assignment vector compressed. Files are replaced atomically, and
+		once the directory holds more than MAX_SIZE bytes the least recently used are removed.
+		:param directory: cache directory, created on first use
+		:param max_size: most bytes the entries may take up together
+		"""
+		self.directory = directory
+		self.max_size = max_size
+
+	def _path(self, key):
+		return os.path.join(self.directory, key + SUFFIX)
+
+	def load(self, key, arrays):
+		"""
+		:param key: search_key of the search
+		:param arrays: MatchArrays of the input
+		:return: the number of iterations taken, (result, iteration) of every iteration that improved on the ones
+				 before it, and compact result (result, iteration, assignment) of the best iteration, or None if
+				 the search is not cached; unreadable entries are removed
+		"""
+		path = self._path(key)
+		try:
+			with open(path, 'rb') as read_file:
+				header = json.loads(read_file.readline())
+				data = zlib.decompress(read_file.read())
+			iterations = header["iterations"]
+			records = [tuple(record) for record in header["records"]]
+			best = records[-1] + (_decode(data, arrays.get_num_students(), arrays.get_num_blocks()),)
+		except FileNotFoundError:
+			return None
+		except (OSError, ValueError, KeyError, IndexError, TypeError, zlib.error):
+			_remove(path)
+			return None
+		# the entry is used now: it is the last to be evicted
+		os.utime(path)
+		return iterations, records, best
+
+	def store(self, key, iterations, records, best):
+		"""
+		Writes the outcome of a search, then evicts the least recently used entries beyond the size of the cache
+		:param key: search_key of the search
+		:param iterations: number of iterations taken
+		:param records: (result, iteration) of every iteration that improved on the ones before it
+		:param best: compact result (result, iteration, assignment) of the best iteration
+		"""
+		os.makedirs(self.directory, exist_ok=True)
+		header = json.dumps({"iterations": iterations, "records": records}).encode("utf-8") + b"\n"
+		data = zlib.compress(_encode(best[2]), 6)
+		handle, temp_name = tempfile.mkstemp(prefix="." + key + ".", suffix=".tmp", dir=self.directory)
+		try:
+			with os.fdopen(handle, 'wb') as write_file:
+				write_file.write(header)
+				write_file.write(data)
+			os.replace(temp_name, self._path(key))
+		except BaseException:
+			_remove(temp_name)
+			raise
+		self.evict(key)
+
+	def evict(self, keep=None):
+		"""
+		Removes the least recently used entries until the rest fit in the size of the cache; KEEP is never removed
+		"""
+		entries = []
+		for name in os.listdir(self.directory):
+			if name.endswith(SUFFIX):
+				try:
+					entry = os.stat(os.path.join(self.directory, name))
+				except FileNotFoundError:
+					continue
+				entries.append((entry.st_mtime, entry.st_size, name))
+		total = sum(size for used, size, name in entries)
+		for used, size, name in sorted(entries):
+			if total <= self.max_size:
+				break
+			if keep is None or name != keep + SUFFIX:
+				_remove(os.path.join(self.directory, name))
+				total -= size
+
+
+def _remove(path):
+	try:
+		os.remove(path)
+	except FileNotFoundError:
+		pass
+
+
+def _encode(assignment):
+	"""
+	:param assignment: assignment vector, or block assignment vector of BlockMatch
+	:return: the session indices as little-endian int32 followed by the current choices as bytes
+	"""
+	pairs = assignment
+	if assignment and isinstance(assignment[0][0], tuple):
+		pairs = list(chain.from_iterable(assignment))
+	sessions = array('i', [session for session, choice in pairs])
+	if sys.byteorder != "little":
+		sessions.byteswap()
+	return sessions.tobytes() + array('b', [choice for session, choice in pairs]).tobytes()
+
+
+def _decode(data, num_students, num_blocks):
+	"""
+	:return: the assignment vector _encode was given, for NUM_STUDENTS students and NUM_BLOCKS time blocks
+	"""
+	num_pairs = num_students * num_blocks
+	sessions = array('i')
+	sessions.frombytes(data[:4 * num_pairs])
+	if sys.byteorder != "little":
+		sessions.byteswap()
+	choices = array('b', data[4 * num_pairs:])
+	if len(sessions) != num_pairs or len(choices) != num_pairs:
+		raise ValueError("cached assignment does not match the input")
+	pairs = list(zip(sessions, choices))
+	if num_blocks == 1:
+		return pairs
+	return list(zip(*[iter(pairs)] * num_blocks))
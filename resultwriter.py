@@ -0,0 +1,175 @@
+#!/usr/bin/python
+
+"""Writes and reads matching results: csv, gzipped csv, or a packed binary array of session indices"""
+
+# native imports
+from array import array
+import csv
+import gzip
+import io
+import os
+import struct
+import sys
+import tempfile
+
+HEADER = ["SID", "Ticket Type"]
+UNASSIGNED = "UNASSIGNED"
+FORMATS = ["csv", "gzip", "packed"]
+# packed files start with MAGIC, then the number of students and sessions, the session names, the SIDs
+# and one int32 session index per student (-1 for unassigned), all little-endian
+MAGIC = b"MATCHPK1"
+BUFFER_SIZE = 1 << 20
+
+
+def format_of(filename):
+	"""
+	:return: the output format implied by the extension of FILENAME: gzip for .gz, packed for .packed, else csv
+	"""
+	if filename.endswith(".gz"):
+		return "gzip"
+	if filename.endswith(".packed"):
+		return "packed"
+	return "csv"
+
+
+def write_assignment(filename, sids, session_names, placement, output_format=None):
+	"""
+	Writes one row per student straight from a flat assignment. The file is written to a temporary file
+	next to FILENAME and renamed over it once complete, so an existing file is replaced atomically and a
+	failed write leaves it untouched.
+	:param filename: output file
+	:param sids: student ids
+	:param session_names: list of session names
+	:param placement: index into SESSION_NAMES per student, in the order of SIDS; -1 for unassigned
+	:param output_format: one of FORMATS; implied by the extension of FILENAME if None
+	:return: number of student rows written
+	"""
+	output_format = output_format or format_of(filename)
+	if output_format not in FORMATS:
+		raise ValueError("unknown output format: " + str(output_format))
+	if output_format == "packed":
+		_replace_file(filename, lambda raw_file: _write_packed(raw_file, sids, session_names, placement))
+	else:
+		_replace_file(filename, lambda raw_file: _write_text(raw_file, output_format, HEADER, sids, session_names,
+															 [placement]))
+	return len(sids)
+
+
+def write_blocks(filename, sids, session_names, placements, output_format=None):
+	"""
+	Writes one row per student with their session in every time block, replacing FILENAME atomically as
+	write_assignment does. Packed files hold one session per student, so only csv and gzip are supported.
+	:param placements: per block, index into SESSION_NAMES per student, in the order of SIDS; -1 for unassigned
+	:return: number of student rows written
+	"""
+	output_format = output_format or format_of(filename)
+	if output_format not in FORMATS:
+		raise ValueError("unknown output format: " + str(output_format))
+	if output_format == "packed":
+		raise ValueError("packed output holds one session per student; write time blocks as csv or gzip")
+	header = [HEADER[0]] + ["Block " + str(block + 1) for block in range(len(placements))]
+	_replace_file(filename, lambda raw_file: _write_text(raw_file, output_format, header, sids, session_names,
+														 placements))
+	return len(sids)
+
+
+def _replace_file(filename, write):
+	"""
+	Calls WRITE with a binary file that replaces FILENAME once WRITE returns, or is removed if it raises
+	"""
+	directory, base = os.path.split(os.path.abspath(filename))
+	handle, temp_name = tempfile.mkstemp(prefix="." + base + ".", suffix=".tmp", dir=directory)
+	try:
+		with os.fdopen(handle, 'wb', buffering=BUFFER_SIZE) as raw_file:
+			write(raw_file)
+		os.chmod(temp_name, 0o666 & ~_umask())
+		os.replace(temp_name, filename)
+	except BaseException:
+		os.remove(temp_name)
+		raise
+
+
+def _write_text(raw_file, output_format, header, sids, session_names, placements):
+	if output_format == "gzip":
+		with gzip.GzipFile(fileobj=raw_file, mode='wb', compresslevel=6) as gzip_file:
+			_write_csv(gzip_file, header, sids, session_names, placements)
+	else:
+		_write_csv(raw_file, header, sids, session_names, placements)
+
+
+def _umask():
+	# mkstemp creates the file readable by its owner only; results get the usual permissions instead
+	umask = os.umask(0)
+	os.umask(umask)
+	return umask
+
+
+def _write_csv(binary_file, header, sids, session_names, placements):
+	text_file = io.TextIOWrapper(binary_file, encoding="utf-8", newline='', write_through=False)
+	try:
+		writer = csv.writer(text_file)
+		writer.writerow(header)
+		# index -1 picks the trailing UNASSIGNED label
+		labels = list(session_names) + [UNASSIGNED]
+		writer.writerows(zip(sids, *[map(labels.__getitem__, placement) for placement in placements]))
+		text_file.flush()
+	finally:
+		text_file.detach()
+
+
+def _write_packed(binary_file, sids, session_names, placement):
+	names = "\n".join(session_names).encode("utf-8")
+	ids = "\n".join(sids).encode("utf-8")
+	indices = array('i', placement)
+	if sys.byteorder != "little":
+		indices.byteswap()
+	binary_file.write(MAGIC)
+	binary_file.write(struct.pack("<II", len(sids), len(session_names)))
+	binary_file.write(struct.pack("<I", len(names)) + names)
+	binary_file.write(struct.pack("<I", len(ids)) + ids)
+	indices.tofile(binary_file)
+
+
+def read_assignment(filename):
+	"""
+	Reads back a file written by write_assignment, in any format
+	:param filename: results file
+	:return: list of (SID, session name or UNASSIGNED) rows
+	"""
+	with open(filename, 'rb') as read_file:
+		magic = read_file.read(len(MAGIC))
+		read_file.seek(0)
+		if magic == MAGIC:
+			return _read_packed(read_file)
+		if magic[:2] == b"\x1f\x8b":
+			with gzip.GzipFile(fileobj=read_file, mode='rb') as gzip_file:
+				return _read_csv(gzip_file)
+		return _read_csv(read_file)
+
+
+def _read_csv(binary_file):
+	rows = []
+	reader = csv.reader(io.TextIOWrapper(binary_file, encoding="utf-8", newline=''))
+	for row in reader:
+		if len(row) >= 2 and row[:2] != HEADER:
+			rows.append((row[0], row[1]))
+	return rows
+
+
+def _read_packed(binary_file):
+	binary_file.read(len(MAGIC))
+	num_students, num_sessions = struct.unpack("<II", binary_file.read(8))
+	names = _read_block(binary_file)
+	ids = _read_block(binary_file)
+	indices = array('i')
+	indices.fromfile(binary_file, num_students)
+	if sys.byteorder != "little":
+		indices.byteswap()
+	labels = (names.split("\n") if num_sessions else []) + [UNASSIGNED]
+	sids = ids.split("\n") if num_students else []
+	return list(zip(sids, map(labels.__getitem__, indices)))
+
+
+def _read_block(binary_file):
+	length, = struct.unpack("<I", binary_file.read(4))
+	return binary_file.read(length).decode("utf-8")
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+"""Deferred acceptance in synchronous rounds: every free student proposes at once and sessions select in bulk"""
+
+# native imports
+from bisect import bisect_left
+from collections import deque
+from itertools import compress, repeat
+from operator import add, and_, floordiv, ge, gt, lshift, mod, not_, or_, sub
+
+# local imports
+from indexedmatch import IndexedMatch, grade_worklist
+
+
+class RoundMatch(IndexedMatch):
+	def __init__(self, arrays, students):
+		"""
+		IndexedMatch that performs the matching round by round instead of one proposal at a time. Once match() is
+		done, the rosters hold the indices of their students only, as assignment() reads them.
+		:param arrays: MatchArrays of the parsed input
+		:param students: student indices, in the order they are first considered
+		"""
+		super(RoundMatch, self).__init__(arrays, students)
+
+	def match(self):
+		"""
+		Performs the national medical school residency matching algorithm, as IndexedMatch.match does, in rounds:
+		every free student of the highest grade left proposes to their next known choice, then every session that
+		got proposals keeps the best of its roster and its applicants up to its capacity and turns the rest away,
+		to propose again in the next round. Grades take their turns as in grade_worklist, so lower grades do not
+		take seats they are turned out of again.
+		A round works on whole lists of ints: every proposal is one int holding the priority of the student and
+		the cell of the choices matrix they propose from. The sessions are read off the matrix with map(), the
+		proposals that cannot beat the worst student of a full session are turned away at once, the others are
+		tagged with their session and sorted, so that every session gets a slice of them and selects with one sort
+		of its roster and applicants, and the students turned away move on to their next choice by adding 1.
+		Python code only runs per session that got proposals, and per student who runs out of choices, meets an
+		unknown session, or was placed by prematch and is turned out.
+		Students of a grade rank by the order they enter its turn, below every student of their grade prematch
+		registered, so priorities are fixed for the turn and the matching is the student-proposing stable matching
+		for them. That is the one IndexedMatch.match finds from the same order of students, which also gives every
+		grade its turn in order; students prematch placed only differ in the order they are turned out in, by
+		higher grades, which can differ between the engines.
+		:return: sum of the grades of unassigned students
+		"""
+		grades = self.arrays.grades
+		keys = self.arrays.priority_keys()
+		num_students = self.arrays.get_num_students()
+		choices = self.arrays.padded_choices()
+		stride = self.arrays.width + 1
+		capacity = self.arrays.capacity
+		current_choice = self.current_choice
+		rosters = self.rosters
+		profile = self.profile
+		names = self.arrays.session_names
+		# priorities are compacted into small ints, so that sorting them stays cheap: every distinct key of the
+		# input is given a level, below which the students of a turn and those prematch registered rank by their
+		# order, which is less than 2 * num_students below the key
+		band = 2 * num_students
+		level_of = dict((key, (index + 1) * band) for index, key in enumerate(sorted(set(keys))))
+		levels = list(map(level_of.__getitem__, keys))
+		# entries pack the compacted priority above the cell of the padded choices matrix the student is at
+		shift = (num_students * stride).bit_length()
+		mask = (1 << shift) - 1
+		# proposals carry their session above the entry, so one sort groups them by session
+		tag = ((len(level_of) + 1) * band).bit_length() + shift
+		entry_mask = (1 << tag) - 1
+		for session, roster in enumerate(rosters):
+			rosters[session] = sorted(((levels[student] + key - keys[student]) << shift) |
+									  (student * stride + current_choice[student]) for key, student in roster)
+		# per session: the worst entry of its roster once it is full, which a proposal must beat; -1 until then
+		cutoff = [-1] * len(rosters)
+		worklist = grade_worklist(self.students, grades.__getitem__)
+		self.students = []
+		while worklist:
+			grade = max(worklist)
+			turn = worklist.pop(grade)
+			# entries of the students of this turn, ranked by the order they entered it
+			proposers = list(map(or_, map(lshift, map(sub, map(levels.__getitem__, turn),
+															 range(num_students, num_students + len(turn))),
+										   repeat(shift)),
+								 map(add, map(stride.__mul__, turn), map(current_choice.__getitem__, turn))))
+			# entries below the turn are of lower-grade students prematch placed
+			floor = (min(proposers) >> shift) << shift if proposers else 0
+			while proposers:
+				sessions = list(map(choices.__getitem__, map(and_, proposers, repeat(mask))))
+				if min(sessions) < 0:
+					proposers, sessions = self._skip_unknown(proposers, sessions, mask)
+				# proposals that do not beat the worst entry of a full session are turned away without a sort
+				beats = list(map(gt, proposers, map(cutoff.__getitem__, sessions)))
+				rejected = list(compress(proposers, map(not_, beats)))
+				if profile:
+					for session in compress(sessions, map(not_, beats)):
+						profile.count("proposals", names[session])
+						profile.count("rejections", names[session])
+				proposals = sorted(map(or_, map(lshift, compress(sessions, beats), repeat(tag)),
+									   compress(proposers, beats)))
+				start = 0
+				while start < len(proposals):
+					session = proposals[start] >> tag
+					end = bisect_left(proposals, (session + 1) << tag, start)
+					roster = rosters[session]
+					if profile:
+						held = set(roster)
+						profile.count("proposals", names[session], end - start)
+					roster.extend(map(and_, proposals[start:end], repeat(entry_mask)))
+					start = end
+					excess = len(roster) - capacity[session]
+					if excess > 0:
+						# worst first: the lowest entries are turned away
+						roster.sort()
+						rejected.extend(roster[:excess])
+						if profile:
+							displaced = len([entry for entry in roster[:excess] if entry in held])
+							profile.count("displacements", names[session], displaced)
+							profile.count("rejections", names[session], excess - displaced)
+						del roster[:excess]
+						cutoff[session] = roster[0] if roster else entry_mask
+				# the students turned away move on to their next choice
+				proposers = list(map(add, rejected, repeat(1)))
+				if proposers and min(proposers) < floor:
+					for entry in proposers:
+						if entry < floor:
+							student, pref = divmod(entry & mask, stride)
+							current_choice[student] = pref
+							worklist.setdefault(grades[student], deque()).append(student)
+					proposers = [entry for entry in proposers if entry >= floor]
+		# the students of every roster, and the choice they are placed at
+		for session, roster in enumerate(rosters):
+			cells = list(map(and_, roster, repeat(mask)))
+			rosters[session] = list(map(floordiv, cells, repeat(stride)))
+			for student, pref in zip(rosters[session], map(mod, cells, repeat(stride))):
+				current_choice[student] = pref
+		# best = least number of higher-grade students left unmatched
+		match_success = 0
+		for student in self.unassigned:
+			match_success += grades[student]
+		return match_success
+
+	def _skip_unknown(self, proposers, sessions, mask):
+		"""
+		Moves the proposers whose current choice is an unknown session or padding on to their next known choice;
+		those who have none left are unassigned
+		:param proposers: entries of the students proposing this round
+		:param sessions: session of the current choice of every proposer, -1 for unknown sessions and padding
+		:param mask: mask of the cell of the padded choices matrix in an entry
+		:return: the entries of the proposers who still have a known choice, and the session of each
+		"""
+		num_choices = self.arrays.num_choices
+		choices = self.arrays.padded_choices()
+		stride = self.arrays.width + 1
+		for index, session in enumerate(sessions):
+			if session < 0:
+				student, pref = divmod(proposers[index] & mask, stride)
+				skipped = pref
+				while pref < num_choices[student] and choices[student * stride + pref] < 0:
+					if self.profile:
+						self.profile.count("unknown_sessions")
+					pref += 1
+				if pref >= num_choices[student]:
+					self.current_choice[student] = pref
+					self.unassigned.append(student)
+				else:
+					proposers[index] += pref - skipped
+					sessions[index] = choices[student * stride + pref]
+		known = list(map(ge, sessions, repeat(0)))
+		return list(compress(proposers, known)), list(compress(sessions, known))
+
+	def assignment(self):
+		"""
+		:return: assignment vector of (session index, current choice) per student index;
+				 session index is -1 for unassigned students
+		"""
+		placement = [-1] * self.arrays.get_num_students()
+		for session, roster in enumerate(self.rosters):
+			for student in roster:
+				placement[student] = session
+		return list(zip(placement, self.current_choice))
@@ -2,149 +2,197 @@
 
 # native imports
 import argparse
+from collections import Counter, deque
 import copy
 import csv
-import os
+from itertools import chain
+from operator import attrgetter
 from pprint import PrettyPrinter
 import random
 import sys
+import time
 
 # local imports
+from blockmatch import BlockMatch, block_bound
+from bulkloader import class_spaces, load_arrays
+from components import find_components, merge_assignments
+from indexedmatch import IndexedMatch, grade_worklist, index_students
+from localsearch import LocalSearch
+from profiling import MatchProfile, phase
+from resultcache import DEFAULT_SIZE, ResultCache, input_seed, search_key
 from smartstudent import SmartStudent
 from smartsession import SmartSession
-from common import choice_str, sum_dictionary
+from common import choice_str, sum_dictionary, derive_seed, in_order, iteration_ranges, map_chunks, SearchBudget
+from resultwriter import FORMATS, format_of, write_assignment, write_blocks
 
 
 class SmartMatch:
+	# True for engines that find the same matching from every seed, which are run once instead of searched
+	single_pass = False
+
 	def __init__(self, students, sessions, integer_class_names):
 		self.class_numbers = integer_class_names
 		self.students = students
 		self.sessions = sessions
 		self.unassigned = set([])
-		self.tallies = None
+		# demand index: total number of student votes per session name, which matching does not change
+		self.tallies = self.tally_choices()
+		# optional MatchProfile counting the events of match()
+		self.profile = None
 
 	def match(self):
 		"""
-		Performs the national medical school residency matching algorithm.
-		:return:
+		Performs the national medical school residency matching algorithm. Free students propose highest grade
+		first (see grade_worklist), and a full session is only changed when a student outranks its worst match,
+		who is then replaced in one heap operation.
+		This gives other matchings than the earlier order, in which the student sent back last proposed next:
+		- every grade takes its turn as a serial dictatorship, so the seed only orders students within a grade;
+		- a displaced student goes on to their next choice, where they used to skip it;
+		- pre-sorted students who are displaced go on from the choice prematch placed them at, not their first.
+		Results are lower for the same number of iterations, and winning seeds printed before the change give
+		other matchings with --replay.
+		:return: sum of the grades of unassigned students
 		"""
-		while self.students:  # while there are unplaced students
-			student = self.students.pop()
-			# get the student's current top choice number
-			pref = student.get_current_choice()
-			if pref < len(student.choices):  # if the student still has preferenced sessions
-				choice = student.get_choice(pref)
-				try:
-					smart_session = self.sessions[choice]
+		profile = self.profile
+		# free students, highest grade first; see grade_worklist
+		worklist = grade_worklist(self.students, attrgetter("grade"))
+		self.students = []
+		while worklist:
+			grade = max(worklist)
+			# drained rather than iterated: students displaced by this turn may join it
+			turn = worklist[grade]
+			while turn:
+				student = turn.popleft()
+				# the student proposes down their choices until a session keeps them
+				pref = student.get_current_choice()
+				while pref < len(student.choices):
+					choice = student.get_choice(pref)
+					smart_session = self.sessions.get(choice)
+					if smart_session is None:
+						if profile:
+							profile.count("unknown_sessions")
+						pref += 1
+						continue
+					if profile:
+						profile.count("proposals", choice)
+					student.current_choice = pref
 					if smart_session.has_space():
 						smart_session.register(student)
-					else:
-						worst_match = smart_session.pop()
-						# if the current student is preferred by the session over the worst match in the session
-						# if smart_session.get_preference(student) > smart_session.get_preference(worst_match):
-						if student.grade > worst_match.grade:
-							# replace the worst match with the current student
-							smart_session.register(student)
-							worst_match.incr_current_choice()
-							self.students.add(worst_match)
-						else:
-							# put back the worst match, increment the current student's preference
-							smart_session.register(worst_match)
-							student.incr_current_choice()
-							self.students.add(student)
-				except KeyError:
-					student.incr_current_choice()
-					self.students.add(student)
-			else:
-				self.unassigned.add(student)
+						if profile:
+							profile.count("heap_operations", choice)
+						break
+					# if the current student is preferred by the session over the worst match in the session
+					if smart_session.outranks(student):
+						# replace the worst match with the current student
+						worst_match = smart_session.replace(student)
+						worklist.setdefault(worst_match.grade, deque()).append(worst_match)
+						if profile:
+							profile.count("displacements", choice)
+							profile.count("heap_operations", choice)
+						break
+					# the session keeps its worst match, which is only looked at
+					if profile:
+						profile.count("rejections", choice)
+					pref += 1
+				student.current_choice = pref
+				if pref >= len(student.choices):
+					self.unassigned.add(student)
+			del worklist[grade]
 		# best = least number of higher-grade students left unmatched
 		match_success = 0
 		for student in self.unassigned:
 			match_success += student.grade
 		return match_success
 
+	def snapshot(self):
+		"""
+		Records the current assignment so the student and session objects can be reused for another iteration
+		:return: list of (student, session name or None, current choice) tuples
+		"""
+		assignments = []
+		for session in self.sessions:
+			for student in self.sessions[session].get_students():
+				assignments.append((student, session, student.get_current_choice()))
+		for student in self.unassigned:
+			assignments.append((student, None, student.get_current_choice()))
+		return assignments
+
+	def restore(self, assignments):
+		"""
+		Rebuilds the session rosters and unassigned set from a snapshot()
+		:param assignments: list of (student, session name or None, current choice) tuples
+		"""
+		for session in self.sessions.values():
+			session.reset()
+		self.students = []
+		self.unassigned = set([])
+		for student, session, choice in assignments:
+			student.reset()
+			student.current_choice = choice
+			if session is None:
+				self.unassigned.add(student)
+			else:
+				self.sessions[session].register(student)
+
+	def tally_choices(self):
+		"""
+		:return: dictionary of total number of student votes, keyed by session name
+		"""
+		session_tallies = dict.fromkeys(self.sessions.keys(), 0)
+		for session in self.sessions.values():
+			for student in session.get_students():
+				for choice in student.choices:
+					if choice in session_tallies:
+						session_tallies[choice] += 1
+		for student in list(self.students) + list(self.unassigned):
+			for choice in student.choices:
+				if choice in session_tallies:
+					session_tallies[choice] += 1
+		return session_tallies
+
 	def prematch(self, top_n):
 		"""Pre-sort students into classes whose capacity is greater than
 			the total number of choices in the top n choices of each student
 		:param top_n: top n choices of each student to tally up
 		:return:
 		"""
-		# tally all choices
-		top_n_tallies = {}
-		session_tallies = dict.fromkeys(self.sessions.keys(), 0)
+		# tally the top n choices; the votes over all choices are already in self.tallies
+		top_n_tallies = Counter(chain.from_iterable(student.choices[:top_n] for student in self.students))
+		pre_placement_sessions = set([])
+		for session, total_choices in top_n_tallies.items():
+			if session in self.sessions and self.sessions[session].get_space() >= total_choices:
+				pre_placement_sessions.add(session)
+		# each student goes to the highest of their top n choices among those sessions, in the order they are
+		# considered, as IndexedMatch.prematch registers them
+		placed_students = set([])
 		for student in self.students:
-			for pref in range(0, len(student.choices)):
-				choice = student.get_choice(pref)
-				if choice in self.sessions:
-					if pref < top_n:
-						if choice not in top_n_tallies:
-							top_n_tallies[choice] = []
-						top_n_tallies[choice].append(student)
-					session_tallies[choice] += 1
-
-		pre_placement_students = set([])
-		pre_placement_sessions = {}
-		for session in top_n_tallies:
-			session_object = self.sessions[session]
-			space = session_object.get_space()
-			total_choices = len(top_n_tallies[session])
-			if space >= total_choices:
-				pre_placement_students.update(top_n_tallies[session])
-				if session_object.get_name() not in pre_placement_sessions:
-					pre_placement_sessions[session_object.get_name()] = session_object
-		while pre_placement_students:
-			student = pre_placement_students.pop()
-			pref = 0
-			placed = False
-			while not placed and pref < top_n:
-				choice = student.get_choice(pref)
+			for pref, choice in enumerate(student.choices[:top_n]):
 				if choice in pre_placement_sessions:
-					pre_placement_sessions[choice].register(student)
-					self.students.remove(student)
-					placed = True
-				pref += 1
-		self.tallies = session_tallies
-
-	def results_to_file(self, file, best):
-		"""Writes the result dictionary to a file in csv format.
-		   File format:
+					student.current_choice = pref
+					self.sessions[choice].register(student)
+					placed_students.add(student)
+					break
+		self.students = [student for student in self.students if student not in placed_students]
+
+	def results_to_file(self, file, output_format=None):
+		"""Writes the result dictionary to a file, replacing any existing file.
+		   File format (csv, optionally gzipped):
 			   SID, CLASSNAME
 		:param file: output file
+		:param output_format: csv, gzip or packed; implied by the extension of FILE if None
 		"""
-		overwrite = "yes"
-		if os.path.isfile(file):
-			overwrite = input("File already exists! " + str(best) +
-							  " students unassigned for this run. Overwrite? (yes/no) (q to quit): ").strip().lower()
-			while not overwrite == "yes" and not overwrite == "no":
-				if overwrite == "q":
-					sys.exit(0)
-				overwrite = input("Please type 'yes', 'no', or 'q': ").strip().lower()
-		written = False
-		while not written and overwrite == "yes":
-			try:
-				with open(file, 'w', newline='') as write_file:
-					writer = csv.writer(write_file)
-					writer.writerow(["SID", "Ticket Type"])
-					num_written = 0
-					for session in self.sessions:
-						student_queue = self.sessions[session].roster
-						processed = []
-						while not student_queue.empty():
-							student = student_queue.get()
-							processed.append(student)
-							line = [student.get_id()] + [session]
-							writer.writerow(line)
-							num_written += 1
-						for student in processed:
-							student_queue.put(student)
-					for student in self.unassigned:
-						line = [student.get_id()] + ["UNASSIGNED"]
-						writer.writerow(line)
-						num_written += 1
-					print("Number of student rows written: " + str(num_written))
-				written = True
-			except IOError:
-				quit = input("Please close the file first (Press Enter to continue...) ")
+		session_names = list(self.sessions)
+		sids = []
+		placement = []
+		for index, session in enumerate(session_names):
+			for student in self.sessions[session].get_students():
+				sids.append(student.get_id())
+				placement.append(index)
+		for student in self.unassigned:
+			sids.append(student.get_id())
+			placement.append(-1)
+		num_written = write_assignment(file, sids, session_names, placement, output_format)
+		print("Number of student rows written: " + str(num_written))
 
 	def stats(self):
 		printer = PrettyPrinter(indent=2)
@@ -167,16 +215,16 @@ class SmartMatch:
 
 		print("### Overall results ###")
 		total = sum_dictionary(total_stats)
-		for key in total_stats:
+		for key in sorted(total_stats, key=_placement_order):
 			print(choice_str(key) + ": " + str(total_stats[key]).rjust(4) + "/" + str(total) +
 				  " ({}%)".format(round(total_stats[key] / (1.0 * total) * 100, 2)))
 		print()
 
 		print("### Breakdown by grade ###")
-		for grade in grade_stats:
+		for grade in sorted(grade_stats, reverse=True):
 			print(str(grade) + "TH GRADE:")
 			grade_choices = grade_stats[grade]
-			for key in grade_choices:
+			for key in sorted(grade_choices, key=_placement_order):
 				print("\t" + choice_str(key) + ": " + str(grade_choices[key]).rjust(3) + "/" + str(
 					total_students[grade]) +
 					  " ({}%)".format(round(grade_choices[key] / (1.0 * total_students[grade]) * 100, 2)))
@@ -204,13 +252,39 @@ class SmartMatch:
 		print()
 
 		print("### " + str(len(self.unassigned)) + " total unassigned students ###")
-		for grade in unassigned_stats:
+		for grade in sorted(unassigned_stats, reverse=True):
 			unassigned = len(unassigned_stats[grade])
 			total = total_students[grade]
 			print(str(grade).rjust(2) + "th grade: " +
 				  str(len(unassigned_stats[grade])).rjust(3) + "/" + str(total_students[grade]) +
 				  " (" + str(round(unassigned/(1.0*total)*100,2)) + "%)")
 
+	def summary(self):
+		"""
+		:return: the figures stats() prints, as a json-serializable dictionary: votes per class, placements per
+				 choice overall and per grade, students, spaces and score per class, and unassigned students
+				 per grade
+		"""
+		grade_stats = self.summarize_assigned_stats()
+		unassigned_stats = self.summarize_unassigned_stats(grade_stats)
+		total_stats, total_students = self.summarize_total_stats(grade_stats)
+		by_grade = {}
+		for grade in sorted(grade_stats, reverse=True):
+			by_grade[grade] = dict((choice_str(key), grade_stats[grade][key])
+								   for key in sorted(grade_stats[grade], key=_placement_order))
+		by_class = {}
+		for name in sorted(self.sessions):
+			session = self.sessions[name]
+			by_class[name] = {"students": session.get_total_students(), "space": session.get_space(),
+							  "score": session.get_score()}
+		return {
+			"votes": self.tallies,
+			"overall": dict((choice_str(key), total_stats[key]) for key in sorted(total_stats, key=_placement_order)),
+			"by_grade": by_grade,
+			"by_class": by_class,
+			"unassigned": dict((grade, len(unassigned_stats[grade])) for grade in sorted(unassigned_stats, reverse=True)),
+		}
+
 	def summarize_total_stats(self, assigned_stats):
 		total_stats = {}
 		total_students = {}
@@ -246,30 +320,28 @@ class SmartMatch:
 		return unassigned_stats
 
 	def summarize_assigned_stats(self):
+		"""
+		Reads the placement counts every session keeps up to date, without going through the rosters
+		:return: dictionary of the number of placed students keyed by grade, then by choice index
+		"""
 		assigned_stats = {}
-		assigned = 0
-		for session in self.sessions:
-			student_queue = self.sessions[session].roster
-			processed = []
-			while not student_queue.empty():
-				student = student_queue.get()
-				processed.append(student)
-				grade_key = student.grade
-				if grade_key not in assigned_stats:
-					assigned_stats[grade_key] = {}
-				choice = student.get_choice_index(session)
-				choice_str = choice
-				if choice_str not in assigned_stats[grade_key]:
-					assigned_stats[grade_key][choice_str] = 0
-				assigned_stats[grade_key][choice_str] += 1
-				assigned += 1
-			for student in processed:
-				student_queue.put(student)
+		for session in self.sessions.values():
+			for (choice, grade_key), num_students in session.get_placements().items():
+				if num_students:
+					grade_stats = assigned_stats.setdefault(grade_key, {})
+					grade_stats[choice] = grade_stats.get(choice, 0) + num_students
 		return assigned_stats
 
 
-def define_students(filename, integer_class_names):
-		"""Returns a set of SmartStudent objects
+def _placement_order(key):
+	# choice indices in order of preference, then "unassigned"
+	return (1, 0) if key == "unassigned" else (0, key)
+
+
+def define_students(filename, integer_class_names, rng=random):
+		"""Returns a list of SmartStudent objects in shuffled order
+		:param rng: random number generator used to shuffle the students; the order they are returned in is
+					the order SmartMatch.match considers them in
 		:requires: students have a unique identifier
 				   student data is in csv format, one student per line:
 				   SID, GRADE_LEVEL, CHOICE_1, CHOICE_2, CHOICE_3, CHOICE_4, CHOICE_5
@@ -288,8 +360,8 @@ def define_students(filename, integer_class_names):
 				else:
 					student = SmartStudent(sid, grade, row[2:])
 				selections.append(student)
-		random.shuffle(selections)
-		return set(selections)
+		rng.shuffle(selections)
+		return selections
 
 
 def define_sessions(filename):
@@ -300,6 +372,7 @@ def define_sessions(filename):
 	:return: dictionary of SmartSession objects
 	:requires: class data is in csv format, one class per line:
 			   CLASSNAME, NUM_SPACES
+			   further columns are left alone, as bulkloader.class_spaces does for classes held in one block
 	"""
 	sessions = {}
 	with open(filename, 'r') as f:
@@ -307,14 +380,385 @@ def define_sessions(filename):
 		for row in reader:
 			name = row[0].strip().lower()
 			try:
-				space = int(row[1])
-			except ValueError:
+				space = class_spaces(row)[0]
+			except (IndexError, ValueError):
 				continue
 			if space > 0:
 				sessions[name] = SmartSession(name, space)
 	return sessions
 
 
+class SmartInput:
+	def __init__(self, students, sessions, integer_class_names, engine=IndexedMatch, arrays=None):
+		"""
+		Parsed students and sessions, loaded once and reused across iterations
+		:param students: collection of SmartStudent objects from define_students, or None if ARRAYS is given
+		:param sessions: dictionary of SmartSession objects from define_sessions, or None if ARRAYS is given
+		:param integer_class_names: classes are integer numbered instead of named
+		:param engine: IndexedMatch or a subclass of it, or a SmartMatch class, used to perform each matching
+		:param arrays: MatchArrays from bulkloader.load_arrays; the student and session objects are then only
+					   built if a SmartMatch needs them
+		"""
+		self.class_numbers = integer_class_names
+		self.engine = engine
+		if arrays is None:
+			# canonical student order, shared by every process of a parallel search
+			self.students = tuple(sorted(students, key=lambda student: student.get_id()))
+			self.sessions = sessions
+			self.session_names = sorted(sessions.keys())
+			self.arrays = index_students(self.students, self.session_names, sessions)
+		else:
+			self.students = None
+			self.sessions = None
+			self.session_names = arrays.session_names
+			self.arrays = arrays
+
+	def get_students(self):
+		"""
+		:return: SmartStudent objects in canonical order, built from the arrays on first use
+		"""
+		if self.students is None:
+			arrays = self.arrays
+			width = arrays.width
+			# choices of sessions missing from the classes file keep an empty name
+			names = arrays.session_names + [""]
+			self.students = tuple(
+				SmartStudent(sid, arrays.grades[student],
+							 [names[index] for index in arrays.choices[student * width:
+																	 student * width + arrays.num_choices[student]]])
+				for student, sid in enumerate(arrays.sids))
+		return self.students
+
+	def get_sessions(self):
+		"""
+		:return: dictionary of SmartSession objects keyed by session name, built from the arrays on first use
+		"""
+		if self.sessions is None:
+			self.sessions = dict((name, SmartSession(name, self.arrays.capacity[index]))
+								 for index, name in enumerate(self.session_names))
+		return self.sessions
+
+	def new_match(self, rng=random):
+		"""
+		Clears the matching state left by the previous iteration and reshuffles the students
+		:param rng: random number generator used to order the students
+		:return: a SmartMatch ready to run
+		"""
+		students = list(self.get_students())
+		rng.shuffle(students)
+		for student in students:
+			student.reset()
+		for session in self.get_sessions().values():
+			session.reset()
+		engine = SmartMatch if issubclass(self.engine, IndexedMatch) else self.engine
+		return engine(students, self.sessions, self.class_numbers)
+
+	def run(self, seed, presort=None, profile=None):
+		"""
+		Performs one seeded matching
+		:param seed: seed for this iteration's random number generator
+		:param presort: top n choices to pre-sort on, if any
+		:param profile: optional MatchProfile to count events and time phases in
+		:return: the result and assignment vector of the matching
+		"""
+		rng = random.Random(seed)
+		if issubclass(self.engine, IndexedMatch):
+			students = list(range(self.arrays.get_num_students()))
+			rng.shuffle(students)
+			engine_match = self.engine(self.arrays, students)
+		else:
+			engine_match = self.new_match(rng)
+		engine_match.profile = profile
+		if profile:
+			profile.iterations += 1
+		if presort:
+			with phase(profile, "prematch"):
+				engine_match.prematch(presort)
+		with phase(profile, "match"):
+			result = engine_match.match()
+		if isinstance(engine_match, IndexedMatch):
+			return result, engine_match.assignment()
+		return result, self.encode(engine_match)
+
+	def search_range(self, seed, start, stop, presort=None, profile=None, budget=None):
+		"""
+		Performs iterations START to STOP of a search and keeps the best one
+		:param budget: optional SearchBudget; the range stops short once its time is up (though a search always
+					   performs its first iteration) or its bound is reached
+		:return: iteration after the last one run, (result, iteration) of every iteration that improved on the
+				 earlier ones, and compact result (result, iteration, assignment) of the best iteration
+		"""
+		best = None
+		records = []
+		for iteration in range(start, stop):
+			if budget and iteration > 0 and budget.expired():
+				return iteration, records, best
+			result, assignment = self.run(derive_seed(seed, iteration), presort, profile)
+			if best is None or result < best[0]:
+				best = (result, iteration, assignment)
+				records.append((result, iteration))
+				if budget and budget.reached(result):
+					return iteration + 1, records, best
+		return stop, records, best
+
+	def encode(self, smart_match):
+		"""
+		:param smart_match: a finished SmartMatch over this input
+		:return: assignment vector of (session index, current choice) per student in canonical order;
+				 session index is -1 for unassigned students
+		"""
+		session_index = dict((name, index) for index, name in enumerate(self.session_names))
+		placement = {}
+		for student, session, choice in smart_match.snapshot():
+			placement[student] = -1 if session is None else session_index[session]
+		return [(placement[student], student.get_current_choice()) for student in self.get_students()]
+
+	def improve(self, assignment):
+		"""
+		Improves a finished matching by local search: ejection chains and bumps of lower-grade students to place
+		unassigned students, then moves and swaps of placed students to sessions they ranked higher; no move leaves
+		a student below a session they ranked higher that holds a student of a lower grade
+		:param assignment: assignment vector of (session index, current choice) per student
+		:return: the result and assignment vector of the improved matching
+		"""
+		local_search = LocalSearch(self.arrays, assignment)
+		result = local_search.improve()
+		return result, local_search.assignment()
+
+	def write(self, filename, assignment, output_format=None):
+		"""
+		Writes an assignment vector from encode() straight to a results file, without building rosters
+		:param filename: output file
+		:param assignment: assignment vector of (session index, current choice) per student, or block assignment
+						   vector of BlockMatch for inputs held in several time blocks
+		:param output_format: csv, gzip or packed; implied by the extension of FILENAME if None
+		:return: number of student rows written
+		"""
+		if self.arrays.get_num_blocks() > 1:
+			return write_blocks(filename, self.arrays.sids, self.session_names,
+								[[placements[block][0] for placements in assignment]
+								 for block in range(self.arrays.get_num_blocks())], output_format)
+		return write_assignment(filename, self.arrays.sids, self.session_names,
+								[index for index, choice in assignment], output_format)
+
+	def decode(self, assignment):
+		"""
+		Materializes an assignment vector from encode() into session rosters
+		:param assignment: assignment vector of (session index, current choice) per student
+		:return: a SmartMatch holding the assignment
+		"""
+		smart_match = self.new_match()
+		assignments = []
+		for student, (index, choice) in zip(self.get_students(), assignment):
+			assignments.append((student, None if index < 0 else self.session_names[index], choice))
+		smart_match.restore(assignments)
+		return smart_match
+
+	def decode_block(self, assignment, block):
+		"""
+		Materializes one time block of a block assignment vector into session rosters; the sessions hold the
+		spaces of BLOCK until the next decode_block
+		:param assignment: block assignment vector of BlockMatch
+		:param block: index of the block
+		:return: a SmartMatch holding the sessions of BLOCK
+		"""
+		capacity = self.arrays.block_capacity[block]
+		for index, name in enumerate(self.session_names):
+			self.get_sessions()[name].set_space(capacity[index])
+		return self.decode([placements[block] for placements in assignment])
+
+
+# state of a search worker process, set once by _init_worker
+_worker_input = None
+
+
+def _init_worker(smart_input):
+	global _worker_input
+	_worker_input = smart_input
+
+
+def _search_chunk(chunk):
+	seed, start, stop, presort, profiled, budget = chunk
+	profile = MatchProfile() if profiled else None
+	stopped, records, best = _worker_input.search_range(seed, start, stop, presort, profile, budget)
+	return start, stop, stopped, records, best, profile.to_dict() if profile else None
+
+
+def search(smart_input, iterations, seed, presort=None, workers=1, progress=None, profile=None, budget=None,
+		   best=None):
+	"""
+	Performs up to ITERATIONS seeded matchings, spread over WORKERS processes, and keeps the best.
+	Each iteration only depends on its derived seed and iterations are taken in order, so the outcome is the
+	same for any number of workers unless the search runs out of time.
+	:param smart_input: parsed SmartInput
+	:param iterations: number of matchings to run; None to run until BUDGET stops the search
+	:param seed: seed of the search
+	:param presort: top n choices to pre-sort on, if any
+	:param workers: number of processes to use
+	:param progress: optional callback taking the number of iterations finished so far
+	:param profile: optional MatchProfile collecting the events and phase times of every iteration
+	:param budget: optional SearchBudget ending the search early; holds the number of iterations taken afterwards
+	:param best: compact result of the best of the iterations BUDGET has already taken in an earlier search with
+				 the same input, seed and presort; the search goes on after them instead of starting over
+	:return: compact result (result, iteration, assignment) of the best iteration; ties go to the earliest
+	"""
+	budget = budget or SearchBudget()
+	first = budget.iterations if best else 0
+	chunks = ((seed, start, stop, presort, profile is not None, budget)
+			  for start, stop in iteration_ranges(iterations, workers, first))
+	results = map_chunks(_search_chunk, chunks, workers, _init_worker, (smart_input,))
+	for start, stop, stopped, records, chunk_best, chunk_profile in in_order(results, first):
+		if chunk_profile:
+			profile.merge(chunk_profile)
+		done = budget.take(records, stopped, stop)
+		if chunk_best and budget.best[1] == chunk_best[1]:
+			best = chunk_best
+		if progress:
+			progress(budget.iterations)
+		if done:
+			break
+	results.close()
+	if best is None or best[1] != budget.best[1]:
+		# the search ended within a range, before that range's own best iteration
+		result, iteration = budget.best
+		best = (result, iteration, smart_input.run(derive_seed(seed, iteration), presort)[1])
+	return best
+
+
+def cached_search(cache, smart_input, iterations, seed, presort=None, workers=1, progress=None, profile=None,
+				  budget=None):
+	"""
+	Performs a search as search() does, through a ResultCache: the iterations an earlier search of the same input,
+	engine, seed and presort took are not run again. If they cover the search, its best iteration is known at once
+	and only replayed if the search stops before the best cached one; otherwise the search goes on after them,
+	from the cached best, and is cached in turn.
+	:param cache: ResultCache
+	:return: compact result (result, iteration, assignment) of the best iteration, and the number of iterations
+			 taken from the cache
+	"""
+	budget = budget or SearchBudget()
+	key = search_key(smart_input.arrays, smart_input.engine, seed, presort)
+	cached = cache.load(key, smart_input.arrays)
+	if cached is None:
+		best = search(smart_input, iterations, seed, presort, workers, progress, profile, budget)
+		cache.store(key, budget.iterations, budget.records, best)
+		return best, 0
+	cached_iterations, records, best = cached
+	if iterations is not None and iterations <= cached_iterations:
+		budget.take([record for record in records if record[1] < iterations], iterations, iterations)
+		covered = True
+	else:
+		# covered if the cached search already ended on the bound or ran out of patience
+		covered = budget.take(records, cached_iterations, cached_iterations)
+	if covered:
+		if budget.best[1] != best[1]:
+			result, iteration = budget.best
+			best = (result, iteration, smart_input.run(derive_seed(seed, iteration), presort)[1])
+		if progress:
+			progress(budget.iterations)
+		return best, budget.iterations
+	best = search(smart_input, iterations, seed, presort, workers, progress, profile, budget, best)
+	cache.store(key, budget.iterations, budget.records, best)
+	return best, cached_iterations
+
+
+def _search_component(job):
+	index, component_input, iterations, seed, presort, profiled, deadline, patience, bound_kind = job
+	profile = MatchProfile() if profiled else None
+	bound = flow_bound(component_input) if bound_kind == "flow" else capacity_bound(component_input.arrays)
+	budget = SearchBudget(None if deadline is None else deadline - time.time(), patience, bound)
+	result, iteration, assignment = search(component_input, iterations, seed, presort, 1, None, profile, budget)
+	return index, result, bound, budget.iterations, assignment, profile.to_dict() if profile else None
+
+
+def search_components(smart_input, components, iterations, seed, presort=None, workers=1, progress=None,
+					  profile=None, time_limit=None, patience=None, bound_kind="capacity"):
+	"""
+	Searches every component of the input on its own and puts the best matchings back together. Components
+	are independent, so the best matching of each gives the best total, and components whose first matching
+	already reaches their lower bound take no more iterations. Components are spread over WORKERS processes,
+	largest first, each searched by one process with the seed derive_seed(SEED, its index).
+	:param smart_input: parsed SmartInput
+	:param components: Components of SMART_INPUT.arrays from find_components
+	:param iterations: most matchings to run per component; None to run until the time limit or patience
+	:param time_limit: seconds after which no component starts a new iteration
+	:param patience: stop searching a component after PATIENCE iterations in a row without improvement
+	:param bound_kind: capacity or flow, the lower bound that ends the search of a component once reached
+	:return: total result, total lower bound, total number of iterations and assignment vector of the input
+	"""
+	deadline = None if time_limit is None else time.time() + time_limit
+	jobs = ((index, SmartInput(None, None, smart_input.class_numbers, smart_input.engine, component.get_arrays()),
+			 iterations, derive_seed(seed, index), presort, profile is not None, deadline, patience, bound_kind)
+			for index, component in enumerate(components))
+	# students in no component chose no existing session, and are never placed
+	in_component = set([])
+	for component in components:
+		in_component.update(component.students)
+	grades = smart_input.arrays.grades
+	unplaceable = sum(grades[student] for student in range(len(grades)) if student not in in_component)
+	total_result = total_bound = unplaceable
+	total_iterations = 0
+	assignments = [None] * len(components)
+	done = 0
+	for index, result, bound, num_iterations, assignment, component_profile in map_chunks(
+			_search_component, jobs, workers):
+		if component_profile:
+			profile.merge(component_profile)
+		total_result += result
+		total_bound += bound
+		total_iterations += num_iterations
+		assignments[index] = assignment
+		done += 1
+		if progress:
+			progress(done)
+	return total_result, total_bound, total_iterations, merge_assignments(smart_input.arrays, components, assignments)
+
+
+def capacity_bound(arrays):
+	"""
+	Lower bound on the sum of the grades of unassigned students, from capacity versus demand: students who chose
+	no existing session are never placed, the students who chose just one session beyond its capacity are not
+	all placed there, and there is no room for the students beyond the total capacity of all sessions
+	:param arrays: MatchArrays of the input
+	:return: the larger of these bounds
+	"""
+	width = arrays.width
+	unplaceable = 0
+	grades = []
+	# session index -> grades of the students who chose only that session
+	single = {}
+	for student in range(arrays.get_num_students()):
+		row = arrays.choices[student * width:student * width + arrays.num_choices[student]]
+		known = set(row)
+		known.discard(-1)
+		if not known:
+			unplaceable += arrays.grades[student]
+			continue
+		grades.append(arrays.grades[student])
+		if len(known) == 1:
+			single.setdefault(known.pop(), []).append(arrays.grades[student])
+	over_session = 0
+	for session in single:
+		excess = len(single[session]) - arrays.capacity[session]
+		if excess > 0:
+			over_session += sum(sorted(single[session])[:excess])
+	excess = len(grades) - sum(arrays.capacity)
+	over_total = sum(sorted(grades)[:excess]) if excess > 0 else 0
+	return unplaceable + max(over_session, over_total)
+
+
+def flow_bound(smart_input):
+	"""
+	Lower bound on the sum of the grades of unassigned students, from the min-cost flow relaxation: the least
+	total grade left unassigned by any placement within capacities, stable or not. Exact, but much slower to
+	compute than capacity_bound on large inputs.
+	:param smart_input: parsed SmartInput
+	"""
+	from flowmatch import FlowMatch
+	smart_match = smart_input.new_match()
+	return FlowMatch(smart_match.students, smart_match.sessions, smart_input.class_numbers).match()
+
+
 # Print iterations progress
 def printProgress (iteration, total, prefix = '', suffix = '', decimals = 1, barLength = 100):
     """
@@ -346,32 +790,169 @@ def main():
 						action="store_true")
 	parser.add_argument("-n", "--numeric",
 						help="classes are integer numbered instead of named", action="store_true")
-	parser.add_argument("--iterate", help="perform the algorithm ITERATE times", type=int, default=1)
+	parser.add_argument("--iterate", help="perform the algorithm up to ITERATE times (default is 1, or no limit " +
+						"with --time-limit or --patience)", type=int)
+	parser.add_argument("--time-limit", help="start no new iteration after TIME_LIMIT seconds", type=float)
+	parser.add_argument("--patience", help="stop after PATIENCE iterations in a row without improvement", type=int)
+	parser.add_argument("--bound", help="lower bound that ends the search once reached: capacity versus demand " +
+						"(default), or the min-cost flow relaxation (exact but slow on large inputs)",
+						choices=["capacity", "flow"], default="capacity")
+	parser.add_argument("--blocks", help="classes are held in BLOCKS time blocks, and every student gets one class " +
+						"in each: the classes file has BLOCKS numbers of spaces per class, one per block, and any " +
+						"further columns are left alone (default is 1)", type=int, default=1)
 	parser.add_argument("--presort", help="pre-sort students into classes whose capacity is greater than " +
 						"the total number of choices in the first PRESORT choices of each student", type=int)
+	parser.add_argument("--engine", help="smart: randomized deferred acceptance, best of ITERATE runs (default); " +
+						"rounds: the same, with all free students proposing at once in every round; " +
+						"flow: optimal assignment in one pass via min-cost flow",
+						choices=["smart", "rounds", "flow"], default="smart")
+	parser.add_argument("--improve", help="improve the best matching by local search: ejection chains, bumps of " +
+						"lower-grade students and swaps, none of which passes over a student of a higher grade",
+						action="store_true")
+	parser.add_argument("--workers", help="spread the iterations over WORKERS processes (default is 1)",
+						type=int, default=1)
+	parser.add_argument("--decompose", help="split the input into independent groups of students and the classes " +
+						"only they chose, and search each group on its own, spread over the workers",
+						action="store_true")
+	seeding = parser.add_mutually_exclusive_group()
+	seeding.add_argument("--seed", help="seed of the random restarts; the same seed gives the same result for any " +
+						 "number of workers", type=int)
+	seeding.add_argument("--replay", help="perform only the matching of winning seed REPLAY, as printed by an " +
+						 "earlier search with the same input files and --presort; seeds printed before grades took " +
+						 "turns at proposing give other matchings", type=int)
+	parser.add_argument("--cache", help="keep the outcome of every search in the directory CACHE, and reuse it for " +
+						"searches of the same input, engine, seed and presort, going on from there if asked for more " +
+						"iterations; without --seed, the seed is derived from the input. Not with --decompose, --replay or " +
+						"--engine flow")
+	parser.add_argument("--cache-size", help="most megabytes the cache takes up; the least recently used searches " +
+						"are removed beyond it (default is " + str(DEFAULT_SIZE // 2 ** 20) + ")", type=float,
+						default=DEFAULT_SIZE / 2 ** 20)
+	parser.add_argument("--profile", help="write event counts and phase timings of the run to PROFILE as json")
+	parser.add_argument("--format", help="output format: csv, gzip (csv) or packed (binary array of session " +
+						"indices); implied by the extension of OUTPUT_CSV (.gz, .packed) by default", choices=FORMATS)
 	parser.add_argument("classes_csv", help="name of the class data csv file to use (relative path)")
 	parser.add_argument("students_csv", help="name of the student data csv file to use (relative path)")
 	parser.add_argument("output_csv", help="name of the (new) csv file to write to (relative path)")
 	args = parser.parse_args()
+	if args.blocks < 1:
+		parser.error("--blocks must be at least 1")
+	if args.blocks > 1:
+		if args.engine != "smart" or args.presort or args.improve or args.decompose or args.bound == "flow":
+			parser.error("--blocks is only supported by the smart engine, without --presort, --improve, " +
+						 "--decompose or --bound flow")
+		if (args.format or format_of(args.output_csv)) == "packed":
+			parser.error("packed output holds one session per student; write time blocks as csv or gzip")
+	if args.decompose and args.replay is not None:
+		parser.error("--replay performs one matching of the whole input and cannot be combined with --decompose")
 
-	best_match = None
-	best_result = float('Inf')
-	for i in range(0, args.iterate):
-		students = define_students(args.students_csv, args.numeric)
-		sessions = define_sessions(args.classes_csv)
-		smart_match = SmartMatch(students, sessions, args.numeric)
-		if args.presort:
-			smart_match.prematch(args.presort)
-		result = smart_match.match()
-		printProgress(i+1, args.iterate, prefix = 'Progress:', suffix = 'Complete')
-		if result < best_result:
-			best_result = result
-			best_match = smart_match
-
-	print()
-	best_match.results_to_file(args.output_csv, len(best_match.unassigned))
+	profile = MatchProfile() if args.profile else None
+	engine = IndexedMatch
+	if args.engine == "flow":
+		from flowmatch import FlowMatch
+		engine = FlowMatch
+	elif args.engine == "rounds":
+		from roundmatch import RoundMatch
+		engine = RoundMatch
+	if engine.single_pass and (args.iterate is not None or args.time_limit is not None or args.patience is not None):
+		parser.error("--engine " + args.engine + " finds its matching in one pass, whatever the seed; --iterate, " +
+					 "--time-limit and --patience do not apply")
+	if args.cache and (args.decompose or args.replay is not None or engine.single_pass):
+		parser.error("--cache keeps searches of the whole input with a search engine; it cannot be combined with " +
+					 "--decompose, --replay or --engine flow")
+	with phase(profile, "parse"):
+		arrays, report = load_arrays(args.classes_csv, args.students_csv, args.numeric, args.blocks)
+	num_blocks = arrays.get_num_blocks()
+	if num_blocks > 1:
+		engine = BlockMatch
+	smart_input = SmartInput(None, None, args.numeric, engine, arrays)
+	if report.has_problems():
+		print(report)
+	if num_blocks > 1:
+		print("Time blocks: " + str(num_blocks))
+	if args.seed is not None:
+		seed = args.seed
+	elif args.cache:
+		# a random seed would make every run a new search, which the cache never answers
+		seed = input_seed(arrays)
+	else:
+		seed = random.randrange(2 ** 32)
+	iterations = args.iterate
+	if iterations is None and args.time_limit is None and args.patience is None:
+		iterations = 1
+	components = []
+	if args.decompose:
+		with phase(profile, "decompose"):
+			components = find_components(smart_input.arrays)
+		print("Independent components: " + str(len(components)))
+	if args.replay is not None:
+		winning_seed = args.replay
+		best_result, best_assignment = smart_input.run(winning_seed, args.presort, profile)
+	elif len(components) > 1:
+		progress = lambda done: printProgress(done, len(components), prefix = 'Components:', suffix = 'Complete')
+		best_result, bound, num_iterations, best_assignment = search_components(
+			smart_input, components, iterations, seed, args.presort, args.workers, progress, profile,
+			args.time_limit, args.patience, args.bound)
+		winning_seed = None
+		print()
+		print("Best result " + str(best_result) + " (lower bound " + str(bound) + ") after " +
+			  str(num_iterations) + " iterations over " + str(len(components)) + " components")
+		print("Search seed: " + str(seed) + " (each component has its own winning seed; rerun this search with " +
+			  "--decompose --seed " + str(seed) + ")")
+	elif engine.single_pass:
+		best_result, best_assignment = smart_input.run(seed, args.presort, profile)
+		winning_seed = None
+		print("Result " + str(best_result) + " of a single matching, the same for every seed")
+	else:
+		with phase(profile, "bound"):
+			if num_blocks > 1:
+				bound = block_bound(smart_input.arrays)
+			elif args.bound == "flow":
+				bound = flow_bound(smart_input)
+			else:
+				bound = capacity_bound(smart_input.arrays)
+		budget = SearchBudget(args.time_limit, args.patience, bound)
+		if iterations is None:
+			progress = lambda done: sys.stdout.write('\rIterations: ' + str(done))
+		else:
+			progress = lambda done: printProgress(done, iterations, prefix = 'Progress:', suffix = 'Complete')
+		if args.cache:
+			cache = ResultCache(args.cache, int(args.cache_size * 2 ** 20))
+			(best_result, best_iteration, best_assignment), num_cached = cached_search(
+				cache, smart_input, iterations, seed, args.presort, args.workers, progress, profile, budget)
+		else:
+			best_result, best_iteration, best_assignment = search(
+				smart_input, iterations, seed, args.presort, args.workers, progress, profile, budget)
+			num_cached = 0
+		winning_seed = derive_seed(seed, best_iteration)
+		print()
+		if num_cached:
+			print("Iterations taken from the cache: " + str(num_cached))
+		print("Best result " + str(best_result) + " (lower bound " + str(bound) + ") after " +
+			  str(budget.iterations) + " iterations")
+	if winning_seed is not None:
+		print("Winning seed: " + str(winning_seed) + " (rerun this matching alone with --replay " +
+			  str(winning_seed) + ")")
+	if args.improve:
+		with phase(profile, "improve"):
+			best_result, best_assignment = smart_input.improve(best_assignment)
+		print("Result " + str(best_result) + " after local search")
+	if profile:
+		profile.seed = winning_seed
+	with phase(profile, "write"):
+		num_written = smart_input.write(args.output_csv, best_assignment, args.format)
+	print("Number of student rows written: " + str(num_written))
 	if args.verbose:
-		best_match.stats()
+		with phase(profile, "stats"):
+			if num_blocks > 1:
+				for block in range(num_blocks):
+					print()
+					print("###### Block " + str(block + 1) + " ######")
+					smart_input.decode_block(best_assignment, block).stats()
+			else:
+				best_match = smart_input.decode(best_assignment)
+				best_match.stats()
+	if profile:
+		profile.write(args.profile)
 
 
 if __name__ == "__main__":
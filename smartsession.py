@@ -1,72 +1,149 @@
 #!/usr/bin/python
 
 # native imports
-import queue
+import heapq
 
 
 # TODO: inheritance removed - reimplement basic methods
 class SmartSession():
 	def __init__(self, name, space):
+		"""
+		Creates a new SmartSession object
+		:param name: name of the class
+		:param space: total space available in the session
+		"""
 		self._name = name.strip().lower()
-		self.roster = queue.PriorityQueue(maxsize=int(space))
+		self._space = int(space)
+		self.reset()
+
+	def reset(self):
+		"""Empties the roster so the session can be reused for another matching"""
+		# min-heap of (priority key + order, SmartStudent): roster[0] is always the worst match, and keys are unique
+		# within a session, so students are never compared
+		self.roster = []
+		self._members = set([])
 		self.order_counter = 0
+		# running statistics, kept up to date by register() and pop()
+		self._score_sum = 0
+		# (current choice of the student, grade): number of registered students
+		self._placements = {}
 
 	def pop(self):
-		smart_student = self.roster.get()
+		"""
+		Removes the worst match from the roster and moves them on to their next choice
+		:return: the removed SmartStudent
+		"""
+		smart_student = heapq.heappop(self.roster)[1]
+		self._remove_stats(smart_student)
 		smart_student.incr_current_choice()
 		return smart_student
 
+	def peek(self):
+		"""
+		:return: the worst match, left in the roster
+		"""
+		return self.roster[0][1]
+
+	def outranks(self, smart_student):
+		"""
+		:return: whether SMART_STUDENT, registered now, would rank above the worst match
+		"""
+		return smart_student.priority + self.order_counter > self.roster[0][0]
+
+	def replace(self, smart_student):
+		"""
+		Registers SMART_STUDENT in place of the worst match, in one heap operation, and moves the worst match on to
+		their next choice
+		:return: the removed SmartStudent
+		"""
+		worst_match = heapq.heapreplace(self.roster, (smart_student.priority + self.order_counter, smart_student))[1]
+		self.order_counter -= 1
+		self._remove_stats(worst_match)
+		self._add_stats(smart_student)
+		worst_match.incr_current_choice()
+		return worst_match
+
+	def remove(self, smart_student):
+		"""
+		Removes a specific student from the roster, without moving them on to their next choice
+		:param smart_student: a registered SmartStudent
+		"""
+		self.roster = [entry for entry in self.roster if entry[1] is not smart_student]
+		heapq.heapify(self.roster)
+		self._remove_stats(smart_student)
+
 	def has_space(self):
-		return not self.roster.full()
+		return len(self.roster) < self._space
 
 	def register(self, smart_student):
-		smart_student.set_order(self.order_counter)
-		self.roster.put(smart_student)
+		heapq.heappush(self.roster, (smart_student.priority + self.order_counter, smart_student))
+		self._add_stats(smart_student)
 		self.order_counter -= 1
 
+	def _add_stats(self, smart_student):
+		# students are registered at the choice that points here, so current_choice is their rank of this session
+		choice_index = smart_student.get_current_choice()
+		self._score_sum += choice_index + 1
+		self._members.add(smart_student)
+		key = (choice_index, smart_student.grade)
+		self._placements[key] = self._placements.get(key, 0) + 1
+
+	def _remove_stats(self, smart_student):
+		choice_index = smart_student.get_current_choice()
+		self._score_sum -= choice_index + 1
+		self._members.discard(smart_student)
+		self._placements[(choice_index, smart_student.grade)] -= 1
+
 	def get_num_students(self, choice_index):
-		count = 0
-		temp_roster = []
-		while not self.roster.empty():
-			student = self.roster.get()
-			if student.get_current_choice() == choice_index:
-				count += 1
-			temp_roster.append(student)
-		for student in temp_roster:
-			self.roster.put(student)
-		return count
+		"""
+		:param choice_index: preference index of this session in the students' choices
+		:return: number of registered students who got this session as that choice
+		"""
+		return sum(count for (choice, grade), count in self._placements.items() if choice == choice_index)
+
+	def get_num_students_in_grade(self, grade):
+		"""
+		:param grade: grade level
+		:return: number of registered students in that grade
+		"""
+		return sum(count for (choice, key), count in self._placements.items() if key == grade)
+
+	def get_placements(self):
+		"""
+		:return: dictionary of the number of registered students, keyed by (their current choice, which points at
+				 this session, grade); kept up to date by register() and pop(), so it must not be modified
+		"""
+		return self._placements
 
 	def get_score(self):
-		score_sum = 0
-		num_students = self.roster.qsize()
-		temp_roster = []
-		while not self.roster.empty():
-			student = self.roster.get()
-			score_sum += student.get_current_choice() + 1
-			temp_roster.append(student)
-		for student in temp_roster:
-			self.roster.put(student)
-		return score_sum / max(1, 1.0 * num_students)
+		"""
+		:return: the score of the class (best = 1.0)
+		"""
+		return self._score_sum / max(1, 1.0 * len(self.roster))
 
 	def get_total_students(self):
-		return self.roster.qsize()
+		return len(self.roster)
+
+	def get_students(self):
+		"""
+		:return: list of the registered SmartStudents, in heap order
+		"""
+		return [smart_student for key, smart_student in self.roster]
 
 	def get_roster_as_set(self):
-		temp_roster = []
-		retset = set([])
-		while not self.roster.empty():
-			student = self.roster.get()
-			temp_roster.append(student)
-			retset.add(student)
-		for student in temp_roster:
-			self.roster.put(student)
-		return retset
+		return set(self._members)
+
+	def contains(self, smart_student):
+		return smart_student in self._members
 
 	def get_name(self):
 		return self._name
 
 	def get_space(self):
-		return self.roster.maxsize
+		return self._space
+
+	def set_space(self, space):
+		self._space = int(space)
 
 	# def get_preference(self, smart_student):
 	# 	return self.preferences[smart_student.get_id()]
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+
+"""Checks that --improve keeps the grade priority of the matching it starts from"""
+
+# native imports
+import os
+import unittest
+
+# local imports
+from bulkloader import load_arrays
+from indexedmatch import IndexedMatch
+from smartmatch import SmartInput, search
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def blocking_pairs(arrays, assignment):
+	"""
+	:param arrays: MatchArrays of the input
+	:param assignment: assignment vector of (session index, current choice) per student
+	:return: list of the (student, session) pairs in which the student ranked the session above their placement, or
+			 chose it and is unassigned, and the session holds a student of a lower grade
+	"""
+	lowest = {}
+	for student, (session, choice) in enumerate(assignment):
+		if session >= 0:
+			lowest[session] = min(lowest.get(session, arrays.grades[student]), arrays.grades[student])
+	pairs = []
+	for student, (session, choice) in enumerate(assignment):
+		options = arrays.known_choices(student)
+		better = options if session < 0 else options[:options.index(session)]
+		for other in better:
+			if other in lowest and lowest[other] < arrays.grades[student]:
+				pairs.append((student, other))
+	return pairs
+
+
+class ImproveTest(unittest.TestCase):
+	def setUp(self):
+		arrays, report = load_arrays(os.path.join(DIRECTORY, "realclasses.csv"),
+									 os.path.join(DIRECTORY, "realinput.csv"), True)
+		self.smart_input = SmartInput(None, None, True, IndexedMatch, arrays)
+
+	def test_no_blocking_pairs(self):
+		result, iteration, assignment = search(self.smart_input, 20, 3)
+		self.assertEqual(blocking_pairs(self.smart_input.arrays, assignment), [])
+		improved_result, improved = self.smart_input.improve(assignment)
+		self.assertLessEqual(improved_result, result)
+		self.assertEqual(blocking_pairs(self.smart_input.arrays, improved), [])
+
+	def test_no_new_blocking_pairs_after_presort(self):
+		# pre-sorted students stay where prematch put them, which can leave blocking pairs; none may be added
+		result, iteration, assignment = search(self.smart_input, 20, 3, 2)
+		pairs = set(blocking_pairs(self.smart_input.arrays, assignment))
+		improved_result, improved = self.smart_input.improve(assignment)
+		self.assertLessEqual(improved_result, result)
+		self.assertLessEqual(set(blocking_pairs(self.smart_input.arrays, improved)), pairs)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -23,7 +23,7 @@ class TestInputGenerator:
 				if overwrite == "q":
 					sys.exit(0)
 				overwrite = input("Please type 'yes', 'no', or 'q': ").strip().lower()
-		choices = self.sessions.keys()
+		choices = list(self.sessions.keys())
 		grades = [9, 10, 11, 12]
 		with open(students_csv, 'r') as in_file:
 			with open(output_csv, 'w', newline='') as out_file:
@@ -48,15 +48,75 @@ class TestInputGenerator:
 		print("Finished! See " + output_csv + " for your new randomly-generated input file.")
 
 
+def generate_synthetic_input(classes_csv, students_csv, num_students, num_sessions, seed=0, skew=1.0,
+							 capacity_ratio=1.0, num_choices=5, grades=(9, 10, 11, 12)):
+	"""
+	Writes a seeded, synthetic pair of class and student files, without prompting.
+	Session popularity follows a Zipf law: the k-th most popular session is chosen with weight 1/k^SKEW.
+	:param classes_csv: class file to write: CLASSNAME, NUM_SPACES
+	:param students_csv: student file to write: SID, GRADE_LEVEL, CHOICE_1, ..., CHOICE_<NUM_CHOICES>
+	:param num_students: number of students
+	:param num_sessions: number of sessions, numbered 1 to NUM_SESSIONS
+	:param seed: random seed; the same arguments always write the same files
+	:param skew: Zipf exponent of session popularity; 0 is uniform
+	:param capacity_ratio: total spaces over number of students; below 1 is tight, above 1 is loose
+	:param num_choices: number of distinct choices per student
+	:param grades: grade levels to draw students from
+	"""
+	rng = random.Random(seed)
+	names = [str(number) for number in range(1, num_sessions + 1)]
+	popularity = list(names)
+	rng.shuffle(popularity)
+	cum_weights = []
+	total_weight = 0.0
+	for rank in range(len(popularity)):
+		total_weight += 1.0 / (rank + 1) ** skew
+		cum_weights.append(total_weight)
+	mean_space = num_students * capacity_ratio / num_sessions
+	with open(classes_csv, 'w', newline='') as out_file:
+		writer = csv.writer(out_file)
+		writer.writerow(["Enrichment", "Caps"])
+		for name in names:
+			writer.writerow([name, max(1, int(round(rng.uniform(0.5, 1.5) * mean_space)))])
+	num_choices = min(num_choices, num_sessions)
+	with open(students_csv, 'w', newline='') as out_file:
+		writer = csv.writer(out_file)
+		writer.writerow(["Student ID#", "Grade"] + [str(choice + 1) for choice in range(num_choices)])
+		for sid in range(1, num_students + 1):
+			chosen = []
+			while len(chosen) < num_choices:
+				for choice in rng.choices(popularity, cum_weights=cum_weights, k=num_choices - len(chosen)):
+					if choice not in chosen:
+						chosen.append(choice)
+			writer.writerow([sid, rng.choice(grades)] + chosen)
+
+
 def main():
 	parser = argparse.ArgumentParser(description="Generates 5 random student choices for each student across the given collection of classes and student IDs.")
 	parser.add_argument("-v", "--verbose", help="output progress to console", action="store_true")
 	parser.add_argument("--randomgrades", help="choose a random grade for each student", action="store_false")
+	parser.add_argument("--synthetic", help="write a seeded synthetic input of STUDENTS students and SESSIONS " +
+						"sessions to CLASSES_CSV and STUDENTS_CSV instead, without prompting", nargs=2, type=int,
+						metavar=("STUDENTS", "SESSIONS"))
+	parser.add_argument("--seed", help="seed of the synthetic input (default 0)", type=int, default=0)
+	parser.add_argument("--skew", help="Zipf exponent of session popularity in the synthetic input (default 1.0)",
+						type=float, default=1.0)
+	parser.add_argument("--capacity", help="total spaces over number of students in the synthetic input " +
+						"(default 1.0)", type=float, default=1.0)
 	parser.add_argument("classes_csv", help="name of the class data csv file to use (relative path)")
 	parser.add_argument("students_csv", help="name of the student data csv file to use (relative path)")
-	parser.add_argument("output_csv", help="name of the (new) csv file to write to (relative path)")
+	parser.add_argument("output_csv", help="name of the (new) csv file to write to (relative path); not used " +
+						"with --synthetic", nargs="?")
 	args = parser.parse_args()
 
+	if args.synthetic:
+		num_students, num_sessions = args.synthetic
+		generate_synthetic_input(args.classes_csv, args.students_csv, num_students, num_sessions, args.seed,
+								 args.skew, args.capacity)
+		print("Finished! See " + args.classes_csv + " and " + args.students_csv + " for your new synthetic input.")
+		return
+	if args.output_csv is None:
+		parser.error("output_csv is required unless --synthetic is given")
 	generator = TestInputGenerator(args.classes_csv)
 	generator.generate_input_from(args.students_csv, args.output_csv, args.verbose, args.randomgrades)
 